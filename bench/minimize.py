@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2025, Thorsten Behrens
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+#
+# 1. Redistributions of source code must retain the above copyright
+# notice, this list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright
+# notice, this list of conditions and the following disclaimer in the
+# documentation and/or other materials provided with the distribution.
+#
+# 3. Neither the name of the copyright holder nor the names of its
+# contributors may be used to endorse or promote products derived from
+# this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+# COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING,
+# BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN
+# ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+"""Measure the xml minimizer: content.xml size, and time to minimize,
+   save and load again, for synthetic decks rendered with and without
+   it"""
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import sys
+import tempfile
+import time
+import zipfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..'))
+
+import mistune  # noqa: E402
+import odpdown  # noqa: E402
+from odfdo.document import Document  # noqa: E402
+from suite import TEMPLATE, WORKLOADS, make_deck  # noqa: E402
+
+
+def measure(text, folder, minimize):
+    """Render text, return dict of timings and content.xml size"""
+    template = odpdown.Template.load(TEMPLATE)
+    with contextlib.redirect_stdout(io.StringIO()):
+        renderer = odpdown.ODFRenderer(
+            template.document, 'Nimbus Mono L', template=template,
+            **template.geometry())
+    mkdown = mistune.Markdown(renderer=renderer)
+    pages = mkdown.render(text).get()
+    start = time.perf_counter()
+    if minimize:
+        odpdown.minimize_elements(pages)
+    minimized = time.perf_counter()
+    target = os.path.join(folder, 'out.odp')
+    odpdown.save_streaming(template.document, target, pages)
+    saved = time.perf_counter()
+    document = Document(target)
+    document.body.get_draw_pages()
+    loaded = time.perf_counter()
+    return {'minimize_seconds': minimized - start,
+            'save_seconds': saved - minimized,
+            'load_seconds': loaded - saved,
+            'content_bytes': len(zipfile.ZipFile(target).read(
+                'content.xml'))}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-w', '--workloads', default='text,code,mixed',
+                        help='Comma-separated workloads to run, out of %s.'
+                        ' [Defaults to text,code,mixed]' %
+                        ', '.join(sorted(WORKLOADS)))
+    parser.add_argument('-s', '--scale', default=2.0, type=float,
+                        help='Multiply slide counts by this. '
+                        '[Defaults to 2]')
+    parser.add_argument('--json', metavar='FILE',
+                        help='Also write results as json to FILE')
+    args = parser.parse_args()
+
+    results = {}
+    print('%-8s %-5s %10s %10s %10s %12s' % (
+        'workload', 'xml', 'minimize', 'save', 'load', 'content.xml'))
+    for name in args.workloads.split(','):
+        params = dict(WORKLOADS[name])
+        params['slides'] = max(1, int(params['slides'] * args.scale))
+        with tempfile.TemporaryDirectory() as folder:
+            text = make_deck(folder, **params)
+            for minimize in (False, True):
+                result = measure(text, folder, minimize)
+                variant = 'lean' if minimize else 'plain'
+                results['%s-%s' % (name, variant)] = result
+                print('%-8s %-5s %9.3fs %9.3fs %9.3fs %12d' % (
+                    name, variant, result['minimize_seconds'],
+                    result['save_seconds'], result['load_seconds'],
+                    result['content_bytes']))
+
+    if args.json:
+        with open(args.json, 'w') as out:
+            json.dump(results, out, indent=2, sort_keys=True)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2025, Thorsten Behrens
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+#
+# 1. Redistributions of source code must retain the above copyright
+# notice, this list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright
+# notice, this list of conditions and the following disclaimer in the
+# documentation and/or other materials provided with the distribution.
+#
+# 3. Neither the name of the copyright holder nor the names of its
+# contributors may be used to endorse or promote products derived from
+# this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+# COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING,
+# BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN
+# ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+
+"""Check ODFPartialTree concatenation scales linearly with output size"""
+
+import sys
+import time
+
+# sets up the path for odpdown, too
+import scaling
+import odpdown
+from odfdo.paragraph import Span
+
+
+class Metrics:
+    outline_size = ('22cm', '12cm')
+    outline_position = ('2cm', '4cm')
+
+
+def fragments(count):
+    """count single-span fragments, as inline rendering produces them.
+       The span is shared, creating odf elements is not what we time"""
+    chunk = [Span(text='x')]
+    return [odpdown.ODFPartialTree.from_metrics_provider(chunk, Metrics)
+            for _ in range(count)]
+
+
+def concat_plus(items):
+    tree = odpdown.ODFPartialTree.from_metrics_provider([], Metrics)
+    for item in items:
+        tree = tree + item
+    assert len(tree.get()) == len(items)
+
+
+def concat_iadd(items):
+    tree = odpdown.ODFPartialTree.from_metrics_provider([], Metrics)
+    for item in items:
+        tree += item
+    assert len(tree.get()) == len(items)
+
+
+def nested_iadd(items):
+    # mistune collects inline output per block, then blocks per list
+    tree = odpdown.ODFPartialTree.from_metrics_provider([], Metrics)
+    for start in range(0, len(items), 10):
+        block = odpdown.ODFPartialTree.from_metrics_provider([], Metrics)
+        for item in items[start:start + 10]:
+            block += item
+        tree += block
+    assert len(tree.get()) == len(items)
+
+
+SCENARIOS = {
+    'concat-plus': concat_plus,
+    'concat-iadd': concat_iadd,
+    'nested-iadd': nested_iadd,
+}
+
+
+def scenario(concat):
+    """Time concat on freshly made fragments"""
+    def run(count):
+        items = fragments(count)
+        start = time.perf_counter()
+        concat(items)
+        return time.perf_counter() - start
+    return run
+
+
+if __name__ == '__main__':
+    sys.exit(scaling.main(__doc__, {name: scenario(concat) for name, concat
+                                    in SCENARIOS.items()},
+                          'element', '2000,8000,32000'))
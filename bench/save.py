@@ -0,0 +1,147 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2025, Thorsten Behrens
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+#
+# 1. Redistributions of source code must retain the above copyright
+# notice, this list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright
+# notice, this list of conditions and the following disclaimer in the
+# documentation and/or other materials provided with the distribution.
+#
+# 3. Neither the name of the copyright holder nor the names of its
+# contributors may be used to endorse or promote products derived from
+# this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+# COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING,
+# BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN
+# ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+"""Time saving an image-heavy deck: odfdo's own zip packaging versus
+   save_streaming with its default compression policy (media stored,
+   large parts deflated in parallel)"""
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..'))
+
+import odpdown  # noqa: E402
+
+TEMPLATE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                        '..', 'cramtest', 'test.odp')
+
+
+def make_images(folder, count, size):
+    """Write count noisy png and jpeg pictures to folder - about as
+       incompressible as photos are"""
+    from PIL import Image
+    rand = random.Random(42)
+    names = []
+    for index in range(count):
+        image = Image.frombytes('RGB', (size, size), bytes(
+            rand.getrandbits(8) for _ in range(size * size * 3)))
+        for ext in ('png', 'jpg'):
+            name = os.path.join(folder, 'image%d.%s' % (index, ext))
+            image.save(name)
+            names.append(name)
+    return names
+
+
+def deck(images):
+    return ''.join('## Slide %d\n\n![picture](%s)\n\n* point one\n'
+                   '* point two\n\n' % (index, name)
+                   for index, name in enumerate(images))
+
+
+def render(text):
+    template = odpdown.Template.load(TEMPLATE)
+    with contextlib.redirect_stdout(io.StringIO()):
+        pages = list(odpdown.render_iter(text.splitlines(True), template))
+    return template.document, pages
+
+
+def save_odfdo(text, target):
+    document, pages = render(text)
+    start = time.perf_counter()
+    for page in pages:
+        document.body.append(page)
+    document.save(target)
+    return time.perf_counter() - start
+
+
+def save_streaming(text, target, **policy):
+    document, pages = render(text)
+    start = time.perf_counter()
+    odpdown.save_streaming(document, target, pages,
+                           compression=odpdown.CompressionPolicy(**policy))
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-n', '--images', default=20, type=int,
+                        help='Number of png/jpeg picture pairs. '
+                        '[Defaults to 20]')
+    parser.add_argument('-s', '--size', default=400, type=int,
+                        help='Picture width and height in pixels. '
+                        '[Defaults to 400]')
+    parser.add_argument('--json', metavar='FILE',
+                        help='Also write results as json to FILE')
+    args = parser.parse_args()
+
+    folder = tempfile.mkdtemp()
+    try:
+        text = deck(make_images(folder, args.images, args.size))
+        variants = [
+            ('odfdo', save_odfdo, {}),
+            ('streaming', save_streaming, {}),
+            ('streaming-1-thread', save_streaming, {'threads': 1}),
+            ('streaming-deflate-all', save_streaming,
+             {'stored_extensions': ()}),
+            ('streaming-deflate-all-1-thread', save_streaming,
+             {'stored_extensions': (), 'threads': 1}),
+        ]
+        results = {}
+        for name, save, policy in variants:
+            target = os.path.join(folder, name + '.odp')
+            elapsed = save(text, target, **policy)
+            results[name] = {'seconds': elapsed,
+                             'bytes': os.path.getsize(target)}
+            print('%-30s %8.3f s %12d bytes' % (name, elapsed,
+                                                results[name]['bytes']))
+    finally:
+        shutil.rmtree(folder)
+
+    if args.json:
+        with open(args.json, 'w') as out:
+            json.dump(results, out, indent=2, sort_keys=True)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
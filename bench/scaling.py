@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2025, Thorsten Behrens
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+#
+# 1. Redistributions of source code must retain the above copyright
+# notice, this list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright
+# notice, this list of conditions and the following disclaimer in the
+# documentation and/or other materials provided with the distribution.
+#
+# 3. Neither the name of the copyright holder nor the names of its
+# contributors may be used to endorse or promote products derived from
+# this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+# COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING,
+# BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN
+# ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+"""Shared harness for the scaling benchmarks: runs each scenario at
+   several sizes, reports time per unit, and optionally fails if that
+   grows by more than a given factor from the smallest size to the
+   largest. The benchmarks only provide their scenarios"""
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..'))
+
+import mistune  # noqa: E402
+import odpdown  # noqa: E402
+from odfdo.document import Document  # noqa: E402
+
+
+def render_markdown(text):
+    """Render text on a fresh renderer, return seconds and pages"""
+    with contextlib.redirect_stdout(io.StringIO()):
+        renderer = odpdown.ODFRenderer(Document('presentation'),
+                                       'Nimbus Mono L')
+    mkdown = mistune.Markdown(renderer=renderer)
+    start = time.perf_counter()
+    pages = mkdown.render(text).get()
+    return time.perf_counter() - start, pages
+
+
+def main(description, scenarios, unit, sizes):
+    """Run scenarios (name -> callable taking the size, returning the
+       seconds taken, or those plus a note to print), at the comma-
+       separated sizes unless given on the command line"""
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument('-s', '--sizes', default=sizes,
+                        help='Comma-separated %s counts. [Defaults to %s]' %
+                        (unit, sizes))
+    parser.add_argument('--json', metavar='FILE',
+                        help='Also write results as json to FILE')
+    parser.add_argument('--max-ratio', default=None, type=float,
+                        help='Fail if time per %s at the largest size '
+                        'exceeds that at the smallest by more than this '
+                        'factor' % unit)
+    args = parser.parse_args()
+    sizes = sorted(int(size) for size in args.sizes.split(','))
+
+    results = {}
+    for name, scenario in scenarios.items():
+        results[name] = {}
+        for count in sizes:
+            elapsed = scenario(count)
+            note = ''
+            if isinstance(elapsed, tuple):
+                elapsed, note = elapsed
+            results[name][count] = elapsed * 1e6 / count
+            line = '%-12s %8d %ss   %8.2f us/%s' % (
+                name, count, unit, results[name][count], unit)
+            print(line + ('   ' + note if note else ''))
+
+    if args.json:
+        with open(args.json, 'w') as out:
+            json.dump(results, out, indent=2, sort_keys=True)
+
+    if args.max_ratio is not None:
+        superlinear = [name for name, timings in results.items()
+                       if timings[sizes[-1]] > (args.max_ratio *
+                                                timings[sizes[0]])]
+        if superlinear:
+            print('not scaling linearly: ' + ', '.join(superlinear))
+            return 1
+    return 0
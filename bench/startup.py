@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2025, Thorsten Behrens
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+#
+# 1. Redistributions of source code must retain the above copyright
+# notice, this list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright
+# notice, this list of conditions and the following disclaimer in the
+# documentation and/or other materials provided with the distribution.
+#
+# 3. Neither the name of the copyright holder nor the names of its
+# contributors may be used to endorse or promote products derived from
+# this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+# COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING,
+# BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN
+# ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+
+"""Measure time-to-first-output of the odpdown command line tool"""
+
+import argparse
+import json
+import os
+import py_compile
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+TOPDIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+ODPDOWN = os.path.join(TOPDIR, 'odpdown')
+TEMPLATE = os.path.join(TOPDIR, 'cramtest', 'test.odp')
+
+
+def scenarios(workdir):
+    """Name -> command line of the startup paths we track"""
+    markdown = os.path.join(workdir, 'startup.md')
+    with open(markdown, 'w') as md:
+        md.write('## Startup\n\n* first item\n')
+    output = os.path.join(workdir, 'startup.odp')
+    return {
+        'version': ['--version'],
+        'argument-error': [],
+        'master-listing': ['--content-master', '--', markdown, TEMPLATE,
+                           output],
+        'convert': [markdown, TEMPLATE, output],
+    }
+
+
+def time_to_first_output(argv):
+    """Seconds from spawning odpdown until it writes anything (or
+       exits, if it stays silent)"""
+    env = dict(os.environ)
+    env.pop('ODPDOWN_SOCKET', None)
+    start = time.perf_counter()
+    proc = subprocess.Popen([sys.executable, ODPDOWN] + argv,
+                            stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                            env=env)
+    proc.stdout.read(1)
+    elapsed = time.perf_counter() - start
+    proc.communicate()
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-r', '--runs', default=10, type=int,
+                        help='Runs per scenario. [Defaults to 10]')
+    parser.add_argument('--json', metavar='FILE',
+                        help='Also write results as json to FILE')
+    parser.add_argument('--max-ms', default=None, type=float,
+                        help='Fail if any scenario besides convert takes '
+                        'longer than that many milliseconds (median)')
+    args = parser.parse_args()
+
+    # time odpdown as installed - with its bytecode compiled already, not
+    # compiling all of odpdown.py per run (PYTHONDONTWRITEBYTECODE)
+    py_compile.compile(os.path.join(TOPDIR, 'odpdown.py'), doraise=True)
+
+    results = {}
+    with tempfile.TemporaryDirectory() as workdir:
+        for name, argv in scenarios(workdir).items():
+            timings = [time_to_first_output(argv) for _ in range(args.runs)]
+            results[name] = {'median_ms': statistics.median(timings) * 1000,
+                             'min_ms': min(timings) * 1000}
+            print('%-16s median %7.1f ms   min %7.1f ms' % (
+                name, results[name]['median_ms'], results[name]['min_ms']))
+
+    if args.json:
+        with open(args.json, 'w') as out:
+            json.dump(results, out, indent=2, sort_keys=True)
+
+    if args.max_ms is not None:
+        slow = [name for name, result in results.items()
+                if name != 'convert' and result['median_ms'] > args.max_ms]
+        if slow:
+            print('too slow: ' + ', '.join(slow))
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
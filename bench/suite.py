@@ -0,0 +1,308 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2025, Thorsten Behrens
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+#
+# 1. Redistributions of source code must retain the above copyright
+# notice, this list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright
+# notice, this list of conditions and the following disclaimer in the
+# documentation and/or other materials provided with the distribution.
+#
+# 3. Neither the name of the copyright holder nor the names of its
+# contributors may be used to endorse or promote products derived from
+# this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+# COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING,
+# BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN
+# ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+"""Benchmark odpdown on synthetic decks, phase by phase: template load,
+   renderer init, parse and render, page insertion and save. Each
+   workload runs in a fresh process, so its peak memory can be recorded
+   too. Results can be compared against a stored baseline"""
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..'))
+
+import mistune  # noqa: E402
+import odpdown  # noqa: E402
+# loaded up front, so the template phase does not time the import
+import odfdo.document  # noqa: E402,F401
+
+TEMPLATE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                        '..', 'cramtest', 'test.odp')
+# results of a default run, as stored by --json
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                        'baseline.json')
+
+PHASES = ('template', 'init', 'render', 'insert', 'save')
+
+# workload name -> deck parameters, slide counts get multiplied by scale
+WORKLOADS = {
+    'text': {'slides': 40, 'depth': 4, 'quotes': True, 'links': True},
+    'code': {'slides': 20, 'code_lines': 60},
+    'images': {'slides': 20, 'images': 2},
+    'tables': {'slides': 10, 'table_rows': 200},
+    'mixed': {'slides': 20, 'depth': 3, 'quotes': True, 'links': True,
+              'code_lines': 20, 'images': 1},
+}
+
+_LISTINGS = {
+    'python': ('def step_{0}(value):\n'
+               '    """Advance value by {0}"""\n'
+               '    return [item + {0} for item in value if item]\n'),
+    'c': ('static int step_{0}(const int *value, size_t n)\n'
+          '{{\n    return n > {0} ? value[{0}] * 2 : -1; /* step */\n}}\n'),
+    'javascript': ('function step{0}(value) {{\n'
+                   '  return value.map((item) => item + {0}); // step\n'
+                   '}}\n'),
+    'bash': ('for f in *.{0}; do\n'
+             '    grep -c "step {0}" "$f" || echo none\ndone\n'),
+}
+
+
+def _bullets(depth, prefix=''):
+    if not depth:
+        return ''
+    return ''.join('%s* item *%d* with `code` and **bold** text\n%s' % (
+        prefix, index, _bullets(depth - 1, prefix + '    '))
+        for index in range(3))
+
+
+def _listing(language, lines):
+    snippet = _LISTINGS[language]
+    text = ''
+    index = 0
+    while text.count('\n') < lines:
+        text += snippet.format(index)
+        index += 1
+    return '```%s\n%s```\n' % (language, ''.join(
+        text.splitlines(True)[:lines]))
+
+
+def make_images(folder, count):
+    """Write count svg and png pictures to folder, return their paths"""
+    from PIL import Image
+    paths = []
+    for index in range(count):
+        svg = os.path.join(folder, 'picture%d.svg' % index)
+        with open(svg, 'w') as out:
+            out.write('<svg xmlns="http://www.w3.org/2000/svg" '
+                      'width="%d" height="120"><rect width="100%%" '
+                      'height="100%%" fill="#%06x"/></svg>\n' %
+                      (160 + index, index * 2654435 % 0xffffff))
+        png = os.path.join(folder, 'picture%d.png' % index)
+        Image.new('RGB', (320, 240 + index),
+                  (index % 256, 128, 255 - index % 256)).save(png)
+        paths.extend((svg, png))
+    return paths
+
+
+def make_table(rows):
+    """Markdown table of rows rows, with some inline markup and text
+       long enough to wrap now and then"""
+    return ('| Id | Owner | State | Notes |\n|---|:---:|---|---|\n' +
+            ''.join('| %d | *owner %d* | **%s** | %s |\n' % (
+                index, index % 7, ('open', 'done')[index % 2],
+                'note ' * (index % 13)) for index in range(rows)))
+
+
+def make_deck(folder, slides, depth=0, quotes=False, links=False,
+              code_lines=0, images=0, table_rows=0):
+    """Markdown for a synthetic deck of slides content slides, plus
+       a breakout slide every ten of them"""
+    pictures = make_images(folder, slides * images)
+    languages = sorted(_LISTINGS)
+    text = ''
+    for index in range(slides):
+        if index % 10 == 0:
+            text += '# Part %d\n\n' % (index // 10)
+        text += '## Slide %d\n\n' % index
+        if depth:
+            text += _bullets(depth) + '\n'
+        if quotes:
+            text += '> A quote on slide %d, _with emphasis_\n\n' % index
+        if links:
+            text += ('See [the docs](https://example.org/%d) and '
+                     '[the reference][ref%d].\n\n[ref%d]: '
+                     'https://example.org/ref/%d\n\n' % ((index,) * 4))
+        if code_lines:
+            text += _listing(languages[index % len(languages)],
+                             code_lines) + '\n'
+        if table_rows:
+            text += make_table(table_rows) + '\n'
+        for picture in pictures[index * images * 2:
+                                (index + 1) * images * 2]:
+            text += '![picture](%s)\n\n' % picture
+    return text
+
+
+def run_workload(name, scale, trace_memory=False):
+    """Run workload in this process, return its per-phase results"""
+    params = dict(WORKLOADS[name])
+    params['slides'] = max(1, int(params['slides'] * scale))
+    timings = {}
+    peaks = {}
+
+    @contextlib.contextmanager
+    def phase(phase_name):
+        if trace_memory:
+            tracemalloc.reset_peak()
+        start = time.perf_counter()
+        yield
+        timings[phase_name] = time.perf_counter() - start
+        if trace_memory:
+            peaks[phase_name] = tracemalloc.get_traced_memory()[1]
+
+    with tempfile.TemporaryDirectory() as folder:
+        text = make_deck(folder, **params)
+        if trace_memory:
+            tracemalloc.start()
+        with contextlib.redirect_stdout(io.StringIO()):
+            with phase('template'):
+                template = odpdown.Template.load(TEMPLATE)
+            with phase('init'):
+                renderer = odpdown.ODFRenderer(
+                    template.document, 'Nimbus Mono L', template=template,
+                    **template.geometry())
+                mkdown = mistune.Markdown(renderer=renderer)
+            with phase('render'):
+                pages = mkdown.render(text).get()
+            with phase('insert'):
+                body = template.document.body
+                for page in pages:
+                    body.append(page)
+            with phase('save'):
+                odpdown.save_streaming(template.document,
+                                       os.path.join(folder, 'out.odp'))
+        if trace_memory:
+            tracemalloc.stop()
+
+    result = {'slides': params['slides'], 'pages': len(pages),
+              'seconds': timings,
+              'total_seconds': sum(timings.values()),
+              'max_rss_kb': resource.getrusage(
+                  resource.RUSAGE_SELF).ru_maxrss}
+    if trace_memory:
+        result['python_peak_bytes'] = peaks
+    return result
+
+
+def run_isolated(name, scale, trace_memory):
+    """Run workload in a fresh interpreter, for a clean peak memory"""
+    argv = [sys.executable, os.path.abspath(__file__), '--run-one', name,
+            '--scale', str(scale)]
+    if trace_memory:
+        argv.append('--trace-memory')
+    return json.loads(subprocess.check_output(argv))
+
+
+def compare(results, baseline, max_slowdown):
+    """Print per-phase time deltas against baseline, return names of
+       workloads slower than max_slowdown times their baseline total"""
+    slow = []
+    for name, result in sorted(results.items()):
+        base = baseline.get(name)
+        if base is None or base['slides'] != result['slides']:
+            print('%-8s no baseline at this scale' % name)
+            continue
+        deltas = ['%s %+.0f%%' % (phase, 100 * (result['seconds'][phase] /
+                                                base['seconds'][phase] - 1))
+                  for phase in PHASES
+                  if base['seconds'].get(phase)]
+        total = result['total_seconds'] / base['total_seconds']
+        print('%-8s total %+.0f%%  (%s)' % (name, 100 * (total - 1),
+                                            ', '.join(deltas)))
+        if max_slowdown is not None and total > max_slowdown:
+            slow.append(name)
+    return slow
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-w', '--workloads', default=','.join(WORKLOADS),
+                        help='Comma-separated workloads to run, out of '
+                        '%s. [Defaults to all]' % ', '.join(WORKLOADS))
+    parser.add_argument('-s', '--scale', default=1.0, type=float,
+                        help='Multiply slide counts by this factor. '
+                        '[Defaults to 1]')
+    parser.add_argument('-r', '--runs', default=3, type=int,
+                        help='Runs per workload, the fastest counts. '
+                        '[Defaults to 3]')
+    parser.add_argument('--trace-memory', action='store_true',
+                        help='Also record peak python heap per phase '
+                        '(slows everything down)')
+    parser.add_argument('--json', metavar='FILE',
+                        help='Also write results as json to FILE')
+    parser.add_argument('--baseline', metavar='FILE', default=BASELINE,
+                        help='Compare against results stored by --json, '
+                        'empty for none. [Defaults to bench/baseline.json]')
+    parser.add_argument('--max-slowdown', default=None, type=float,
+                        help='Fail if any workload takes more than this '
+                        'factor of its baseline time')
+    parser.add_argument('--run-one', metavar='WORKLOAD',
+                        help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run_one:
+        json.dump(run_workload(args.run_one, args.scale, args.trace_memory),
+                  sys.stdout)
+        return 0
+
+    results = {}
+    for name in args.workloads.split(','):
+        runs = [run_isolated(name, args.scale, args.trace_memory)
+                for _ in range(args.runs)]
+        result = min(runs, key=lambda run: run['total_seconds'])
+        result['max_rss_kb'] = max(run['max_rss_kb'] for run in runs)
+        results[name] = result
+        print('%-8s %4d pages  %s  total %7.3f s  rss %7.1f MB' % (
+            name, result['pages'],
+            '  '.join('%s %6.3f' % (phase, result['seconds'][phase])
+                      for phase in PHASES),
+            result['total_seconds'], result['max_rss_kb'] / 1024.))
+
+    if args.json:
+        with open(args.json, 'w') as out:
+            json.dump(results, out, indent=2, sort_keys=True)
+
+    if args.baseline:
+        print('against %s:' % os.path.relpath(args.baseline))
+        with open(args.baseline) as base:
+            slow = compare(results, json.load(base), args.max_slowdown)
+        if slow:
+            print('slower than baseline: ' + ', '.join(slow))
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
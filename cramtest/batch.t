@@ -0,0 +1,14 @@
+  $ printf '## First\n\n* item\n' > $CRAMTMP/first.md
+  $ printf '## Second\n\n![missing](missing.png)\n' > $CRAMTMP/second.md
+  $ printf '# nightly decks\nfirst.md first.odp\n\nsecond.md second.odp\n' > $CRAMTMP/jobs.txt
+  $ $TESTDIR/../odpdown --batch $CRAMTMP/jobs.txt -j 2 $TESTDIR/test.odp $CRAMTMP/first.md $CRAMTMP/third.odp 2> $CRAMTMP/batch.err
+  ok       *s  */first.md -> */first.odp (glob)
+  FAILED   *s  */second.md: FileNotFoundError: * (glob)
+  ok       *s  */first.md -> */third.odp (glob)
+  2 converted, 1 failed in *s (glob)
+  [1]
+  $ test -s $CRAMTMP/first.odp && test -s $CRAMTMP/third.odp && test ! -e $CRAMTMP/second.odp
+  $ grep -c Traceback $CRAMTMP/batch.err
+  1
+  $ $TESTDIR/../odpdown --batch $CRAMTMP/jobs.txt $TESTDIR/test.odp $CRAMTMP/first.md 2>&1 | tail -1
+  odpdown: error: input and output files must come in pairs
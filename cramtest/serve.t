@@ -0,0 +1,22 @@
+  $ export ODPDOWN_SOCKET=$CRAMTMP/odpdown.sock
+  $ $TESTDIR/../odpdown serve -S $ODPDOWN_SOCKET $TESTDIR/test.odp > $CRAMTMP/serve.log 2>&1 & echo $! > $CRAMTMP/serve.pid
+  $ for i in $(seq 50); do test -S $ODPDOWN_SOCKET && break; sleep 0.1; done
+  $ cat $CRAMTMP/serve.log
+  odpdown serving on */odpdown.sock (glob)
+  $ stat -c %a $ODPDOWN_SOCKET
+  600
+  $ printf '## Served slide\n\n* item\n' > $CRAMTMP/served.md
+  $ $TESTDIR/../odpdown $CRAMTMP/served.md $TESTDIR/test.odp $CRAMTMP/served.odp 2> /dev/null && test -s $CRAMTMP/served.odp
+  $ cat $CRAMTMP/served.md | $TESTDIR/../odpdown - $TESTDIR/test.odp $CRAMTMP/served2.odp 2> /dev/null && test -s $CRAMTMP/served2.odp
+  $ $TESTDIR/../odpdown --content-master=bla $CRAMTMP/served.md $TESTDIR/test.odp $CRAMTMP/served3.odp | tail -3
+   - Standard
+   - Default
+   - libreoffice_5f_en
+  $ $TESTDIR/../odpdown $CRAMTMP/missing.md $TESTDIR/test.odp $CRAMTMP/served4.odp 2> /dev/null
+  [1]
+  $ kill $(cat $CRAMTMP/serve.pid) && sleep 0.5 && test ! -e $ODPDOWN_SOCKET
+  $ cat $CRAMTMP/served.md | $TESTDIR/../odpdown - $TESTDIR/test.odp $CRAMTMP/served5.odp 2> /dev/null && test -s $CRAMTMP/served5.odp
+  $ touch $CRAMTMP/not-a-socket
+  $ $TESTDIR/../odpdown serve -S $CRAMTMP/not-a-socket 2>&1 | tail -1
+  odpdown serve: error: */not-a-socket exists and is not a socket (glob)
+  $ test -f $CRAMTMP/not-a-socket
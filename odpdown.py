@@ -44,36 +44,49 @@
 #
 import argparse
 import codecs
+import collections
+import copy
+import hashlib
 import io
+import itertools
+import json
+import math
 import mistune
+import os
 import re
+import stat
 import sys
+import time
 import urllib.parse
+import weakref
+
+from contextlib import (contextmanager, nullcontext, redirect_stderr,
+                        redirect_stdout)
 
-from urllib.request import urlopen
 from mimetypes import guess_type
 from uuid import uuid4
 
-from odfdo.const import ODF_MANIFEST, ODF_STYLES
-from odfdo.document import Document
-from odfdo.frame import Frame
-from odfdo.draw_page import DrawPage
-from odfdo.list import List, ListItem
-from odfdo.style import Style
-from odfdo.paragraph import Paragraph, Span
-from odfdo.paragraph import LineBreak, Spacer
-from odfdo.paragraph import Tab
-from odfdo.link import Link
 
-from pygments.lexers import get_lexer_by_name
-from pygments.formatter import Formatter
+# odfdo makes up the bulk of our import time, but is not needed for
+# e.g. --version or argument errors. Functions import it on first use -
+# same for pygments, and for modules only serving, batches or saving need.
 
 __version__ = '0.5.0'
 __author__ = 'Thorsten Behrens <tbehrens@acm.org>'
-__all__ = [
+# ODFFormatter and ConversionServer get defined lazily, see __getattr__
+__all__ = [  # noqa: F822
     'ODFRenderer', 'ODFRenderer',
     'ODFFormatter', 'ODFFormatter',
     'ODFPartialTree', 'ODFPartialTree',
+    'ConversionServer', 'convert', 'load_template',
+    'SlideCache', 'split_slides', 'render_slides', 'iter_slides',
+    'render_iter',
+    'HighlightCache', 'get_lexer', 'get_formatter', 'add_highlight_styles',
+    'ImagePrefetcher', 'find_images', 'load_image', 'probe_image',
+    'optimize_pictures', 'picture_targets', 'RemoteImageCache', 'Template',
+    'StyleIndex', 'style_index', 'save_streaming', 'CompressionPolicy',
+    'SlideSpool',
+    'Profiler',
 ]
 
 _master_page_spew = '''
@@ -89,21 +102,164 @@ Available master page names in template:
 '''.strip()
 
 
+# part of the slide and highlight cache keys, next to __version__ - bump
+# whenever the odf generated for either changes
+_cache_format = 2
+
+
 # helper for unique hashes
 def hasher():
     return uuid4()
 
 
+def _style_family(style):
+    return getattr(style, 'family', None) or style.get_attribute(
+        'style:family')
+
+
+def _same_style(style, other):
+    return style.serialize() == other.serialize()
+
+
+class StyleIndex:
+    """Index of document styles by (family, name), and of master pages
+       with their placeholder frames by presentation class. Saves the
+       xpath walks odfdo does per lookup and insertion - so insert
+       automatic styles through here, once indexed. Doubles of an
+       automatic style get dropped, inserting one the document has
+       already is a no-op. Use style_index() to get the one index per
+       document"""
+
+    def __init__(self, document):
+        self.document = document
+        content = document.content
+        self._font_faces = content.get_element('//office:font-face-decls')
+        self._automatic_styles = content.get_element(
+            '//office:automatic-styles')
+        # automatic styles (and font faces) in content.xml
+        self.automatic = {}
+        for container in (self._font_faces, self._automatic_styles):
+            if container is None:
+                continue
+            for style in container.children:
+                key = (_style_family(style),
+                       style.get_attribute('style:name'))
+                existing = self.automatic.setdefault(key, style)
+                if existing is not style and _same_style(existing, style):
+                    container.delete(style)
+        # (family, name) -> add_style() arguments it got inserted from
+        self.specs = {}
+        # styles.xml gets indexed on first use only - rendering onto an
+        # analysed Template just inserts automatic styles
+        self._styles = None
+        self._master_pages = None
+        self._placeholders = None
+
+    def _index_styles(self):
+        from odfdo.const import ODF_STYLES
+        # styles.xml, including master page styles
+        self._styles = {}
+        styles = self.document.get_part(ODF_STYLES)
+        for style in styles.get_elements('descendant::style:style'):
+            self._styles.setdefault((style.get_attribute('style:family'),
+                                     style.get_attribute('style:name')),
+                                    style)
+        # master name -> master page, in document order
+        self._master_pages = collections.OrderedDict()
+        # master name -> presentation class -> last such frame
+        self._placeholders = {}
+        for page in styles.get_elements('descendant::style:master-page'):
+            master_name = page.get_attribute('style:name')
+            self._master_pages[master_name] = page
+            frames = self._placeholders[master_name] = {}
+            for frame in page.get_elements('descendant::draw:frame'):
+                attr = frame.get_attribute('presentation:class')
+                if attr is not None:
+                    frames[attr] = frame
+
+    @property
+    def styles(self):
+        if self._styles is None:
+            self._index_styles()
+        return self._styles
+
+    @property
+    def master_pages(self):
+        if self._master_pages is None:
+            self._index_styles()
+        return self._master_pages
+
+    @property
+    def placeholders(self):
+        if self._placeholders is None:
+            self._index_styles()
+        return self._placeholders
+
+    @property
+    def master_names(self):
+        return list(self.master_pages)
+
+    def get_style(self, family, name):
+        """Style of given family and name, automatic ones first"""
+        style = self.automatic.get((family, name))
+        if style is None:
+            style = self.styles.get((family, name))
+        return style
+
+    def placeholder(self, master_name, presentation_class):
+        """Placeholder frame of master page, or None"""
+        return self.placeholders.get(master_name, {}).get(presentation_class)
+
+    def insert_style(self, style):
+        """Insert automatic style, replacing a different one of same
+           family and name (same as Document.insert_style does). Returns
+           the style now in the document - an equal one already there
+           stays"""
+        family = _style_family(style)
+        key = (family, style.get_attribute('style:name'))
+        container = (self._font_faces if family == 'font-face'
+                     else self._automatic_styles)
+        existing = self.automatic.get(key)
+        if existing is not None:
+            if _same_style(existing, style):
+                return existing
+            container.delete(existing)
+        self.specs.pop(key, None)
+        container.append(style)
+        self.automatic[key] = style
+        return style
+
+
+_style_indexes = weakref.WeakKeyDictionary()
+
+
+def style_index(document):
+    """Return StyleIndex of document, building it on first use"""
+    index = _style_indexes.get(document)
+    if index is None:
+        index = _style_indexes[document] = StyleIndex(document)
+    return index
+
+
 # helper for ODFFormatter and ODFRenderer
 def add_style(document, style_family, style_name,
               properties, parent=None):
-    """Insert global style into given document"""
+    """Insert global style into given document, unless it has the very
+       same already"""
+    from odfdo.style import Style
+    index = style_index(document)
+    key = (style_family, style_name)
+    spec = (repr(properties), parent)
+    if index.specs.get(key) == spec:
+        # inserted from the same arguments before
+        return
     style = Style(family=style_family, name=style_name,
                   display_name=style_name, parent_style=parent)
     for elem in properties:
         # pylint: disable=maybe-no-member
         style.set_properties(properties=elem[1], area=elem[0])
-    document.insert_style(style, automatic=True)
+    index.insert_style(style)
+    index.specs[key] = spec
 
 
 def wrap_spans(odf_elements):
@@ -112,8 +268,9 @@ def wrap_spans(odf_elements):
     res = []
     para = None
     for elem in odf_elements:
-        if isinstance(elem, Span) or isinstance(elem, Link):
+        if _xml_tag(elem) in (_span_tag, _link_tag):
             if para is None:
+                from odfdo.paragraph import Paragraph
                 para = Paragraph()
             para.append(elem)
         else:
@@ -142,10 +299,12 @@ def handle_whitespace(text):
             # split off tabulators and whitespace
             if part[:2] == '  ':
                 # multiple spaces in ODF need markup
+                from odfdo.paragraph import Spacer
                 result.append(
                     Spacer(len(part)))
             elif part[:1] == '\t':
                 # insert an actual tab
+                from odfdo.paragraph import Tab
                 result.append(
                     Tab())
             else:
@@ -154,11 +313,129 @@ def handle_whitespace(text):
 
         # for all but the last line: add linebreak
         if index < len(lines)-1:
+            from odfdo.paragraph import LineBreak
             result.append(LineBreak())
 
     return result
 
 
+# xml tags the minimizer below works on, in lxml's clark notation
+_text_ns = '{urn:oasis:names:tc:opendocument:xmlns:text:1.0}'
+_span_tag = _text_ns + 'span'
+_spacer_tag = _text_ns + 's'
+_spacer_count = _text_ns + 'c'
+_line_break_tag = _text_ns + 'line-break'
+_link_tag = _text_ns + 'a'
+_draw_ns = '{urn:oasis:names:tc:opendocument:xmlns:drawing:1.0}'
+_draw_page_tag = _draw_ns + 'page'
+_draw_frame_tag = _draw_ns + 'frame'
+_table_tag = '{urn:oasis:names:tc:opendocument:xmlns:table:1.0}table'
+_inline_parent_tags = frozenset(
+    _text_ns + tag for tag in ('p', 'h', 'span', 'a'))
+
+
+def _xml_tag(elem):
+    """lxml tag of an odfdo element, None for anything else. Way
+       cheaper than its tag property, and than importing odfdo classes
+       for isinstance() checks"""
+    xml_element = getattr(elem, '_xml_element', None)
+    return None if xml_element is None else xml_element.tag
+
+
+def _is_table_frame(elem):
+    """Whether elem is a frame ODFRenderer.table() put a table into"""
+    if _xml_tag(elem) != _draw_frame_tag:
+        return False
+    # pylint: disable=protected-access
+    node = elem._xml_element
+    return len(node) > 0 and node[0].tag == _table_tag
+
+
+def _split_tables(elems):
+    """Split elems into runs of table frames and of other elements, as
+       (is_table, run) pairs"""
+    return [(is_table, list(run))
+            for is_table, run in itertools.groupby(elems, _is_table_frame)]
+
+
+def _append_text(parent, prev, text):
+    """Add text right after prev, a child of parent (or at the start of
+       parent if prev is None)"""
+    if not text:
+        return
+    if prev is None:
+        parent.text = (parent.text or '') + text
+    else:
+        prev.tail = (prev.tail or '') + text
+
+
+def _unwrap(parent, node):
+    """Replace node by its content, keeping its tail"""
+    prev = node.getprevious()
+    tail, node.tail = node.tail, None
+    _append_text(parent, prev, node.text)
+    for child in list(node):
+        node.addprevious(child)
+        prev = child
+    _append_text(parent, prev, tail)
+    parent.remove(node)
+
+
+def _joinable(prev, node):
+    """Whether node can join prev, its left neighbour"""
+    return (prev is not None and not prev.tail and prev.tag == node.tag and
+            (node.tag == _spacer_tag or node.attrib == prev.attrib))
+
+
+def _join(prev, node):
+    """Move content and tail of node into prev, its left neighbour, and
+       drop node. Returns the first child moved over, which may now be
+       joinable to its own left neighbour"""
+    if node.tag == _spacer_tag:
+        prev.set(_spacer_count, str(int(prev.get(_spacer_count, 1)) +
+                                    int(node.get(_spacer_count, 1))))
+        moved = ()
+    else:
+        children = list(prev)
+        _append_text(prev, children[-1] if children else None, node.text)
+        moved = list(node)
+        for child in moved:
+            prev.append(child)
+    prev.tail, node.tail = node.tail, None
+    prev.getparent().remove(node)
+    return moved[0] if moved and not node.text else None
+
+
+def minimize_elements(elements):
+    """Shrink the xml of rendered odf elements in place, keeping what
+       it displays: drop spans without style or content, merge adjacent
+       spans of the same style and runs of spacers"""
+    for elem in elements:
+        root = elem._xml_element  # pylint: disable=protected-access
+        # innermost first, so emptied wrappers go as well
+        for node in reversed(list(root.iter(_span_tag))):
+            parent = node.getparent()
+            if parent.tag in _inline_parent_tags and (
+                    not node.attrib or (not node.text and not len(node))):
+                _unwrap(parent, node)
+        for node in reversed(list(root.iter(_span_tag, _spacer_tag))):
+            while node is not None and _joinable(node.getprevious(), node):
+                node = _join(node.getprevious(), node)
+    return elements
+
+
+def _outline_text_box(page):
+    """Return text box of the outline frame on page, or None. Found
+       once, then remembered on the page object"""
+    text_box = getattr(page, 'odpdown_outline', None)
+    if text_box is None:
+        for child in page.get_elements('descendant::draw:frame'):
+            if child.presentation_class == 'outline':
+                text_box = page.odpdown_outline = child.children[0]
+                break
+    return text_box
+
+
 # really quite an ugly hack. but unfortunately, mistune at a few
 # non-overridable places use '+' and '+=' to concatenate render method
 # returns. Due to the nature of the parser, to preserve output
@@ -166,71 +443,103 @@ def handle_whitespace(text):
 # methods (that will then need to be concatenated via +/+=).
 class ODFPartialTree:
     """Output object for mistune, used to collect formatter fragments
-       via +/+= operators"""
-    def __init__(self, elements, outline_size, outline_position):
-        self._elements = elements
+       via +/+= operators.
+
+       Fragments are kept as a persistent linked list of element chunks
+       (shared between trees, never modified), so both + and += are
+       O(1) - get() joins the chunks once, on demand."""
+    __slots__ = ('_chunks', 'outline_size', 'outline_position',
+                 'page_continuation', 'place_table')
+
+    def __init__(self, elements, outline_size, outline_position,
+                 page_continuation=None, place_table=None):
+        # None, or (previous chunks, non-empty element list)
+        self._chunks = (None, elements) if elements else None
         self.outline_size = outline_size
         self.outline_position = outline_position
+        # None, or callable giving a new page for content not fitting
+        # onto the page passed - or None, for pages that still have room
+        self.page_continuation = page_continuation
+        # None, or callable putting table frames onto the page passed,
+        # returning the pages it needed on top
+        self.place_table = place_table
 
     @classmethod
     def from_metrics_provider(cls, elements, metrics_provider):
         """Initialize ODFPartialTree from a metrics provider"""
         return cls(elements,
                    metrics_provider.outline_size,
-                   metrics_provider.outline_position)
+                   metrics_provider.outline_position,
+                   getattr(metrics_provider, 'page_continuation', None),
+                   getattr(metrics_provider, 'place_table', None))
 
     def add_child_elems(self, elems):
         """Helper to add elems to self as children"""
+        if not len(elems):
+            return
+        last = self._chunks[1][-1] if self._chunks is not None else None
         # TODO: kill this ugly typeswitching
-        if (len(self._elements) and
-            isinstance(
-                self._elements[-1], DrawPage) and not
-            isinstance(
-                elems[0], DrawPage)):
+        if (_xml_tag(last) == _draw_page_tag and
+                _xml_tag(elems[0]) != _draw_page_tag):
+
+            if (self.place_table is not None and
+                    any(map(_is_table_frame, elems))):
+                # tables get pages of their own
+                for is_table, run in _split_tables(elems):
+                    if is_table:
+                        pages = self.place_table(self._chunks[1][-1], run)
+                        if pages:
+                            self._chunks = (self._chunks, pages)
+                    else:
+                        self.add_child_elems(run)
+                return
+
+            continuation = (None if self.page_continuation is None
+                            else self.page_continuation(last))
+            if continuation is not None:
+                # a table fills the last page - go on on a new one
+                last = continuation
+                self._chunks = (self._chunks, [last])
 
             # stick additional frame content into last existing one
-            for child in self._elements[-1].get_elements(
-                    'descendant::draw:frame'):
-                if child.presentation_class == 'outline':
-                    text_box = child.children[0]
-                    for elem in wrap_spans(elems):
-                        text_box.append(elem)
-                    return
+            text_box = _outline_text_box(last)
+            if text_box is not None:
+                for elem in wrap_spans(elems):
+                    text_box.append(elem)
+                return
 
             # special-case image frames - append to pages literally!
+            from odfdo.frame import Frame
             if isinstance(elems[0], Frame):
                 for child in elems:
-                    self._elements[-1].append(child)
+                    last.append(child)
             else:
                 # no outline frame found, create new one with elems content
                 elems = wrap_spans(elems)
-                self._elements[-1].append(
-                    Frame.text_frame(
-                        elems,
-                        presentation_style='md2odp-OutlineText',
-                        size=('%s' % self.outline_size[0],
-                              '%s' % self.outline_size[1]),
-                        position=('%s' % self.outline_position[0],
-                                  '%s' % self.outline_position[1]),
-                        presentation_class='outline'))
+                frame = Frame.text_frame(
+                    elems,
+                    presentation_style='md2odp-OutlineText',
+                    size=('%s' % self.outline_size[0],
+                          '%s' % self.outline_size[1]),
+                    position=('%s' % self.outline_position[0],
+                              '%s' % self.outline_position[1]),
+                    presentation_class='outline')
+                last.append(frame)
+                last.odpdown_outline = frame.children[0]
         else:
-            self._elements += elems
+            self._chunks = (self._chunks, elems)
 
     def add_text(self, text):
         """Helper to ctext to self"""
+        from odfdo.paragraph import Span
         span = Span()
         span.text = str(text)
-        self._elements.append(span)
+        self._chunks = (self._chunks, [span])
 
     def __add__(self, other):
         """Override of +"""
-        tmp = ODFPartialTree(list(self._elements),
-                             self.outline_size,
-                             self.outline_position)
-        if isinstance(other, str):
-            tmp.add_text(other)
-        else:
-            tmp.add_child_elems(other.get())
+        tmp = self.__copy__()
+        tmp += other
         return tmp
 
     def __iadd__(self, other):
@@ -242,167 +551,1004 @@ class ODFPartialTree:
         return self
 
     def __copy__(self):
-        """Override for deep copy"""
-        return ODFPartialTree(self._elements[:],
-                              self.outline_size,
-                              self.outline_position)
+        """Override for copy - chunks are shared, not copied"""
+        tmp = ODFPartialTree(None, self.outline_size, self.outline_position,
+                             self.page_continuation, self.place_table)
+        tmp._chunks = self._chunks
+        return tmp
 
     def get(self):
-        """Get list of odf_element elements"""
-        return self._elements
-
-
-# parts from http://pygments.org/docs/formatterdevelopment/, BSD
-# license
-class ODFFormatter(Formatter):
-    """Format pygment token stream as ODF"""
-    def __init__(self, **options):
-        Formatter.__init__(self, **options)
-
-        # buffer regex for tab/space splitting for block code
-        self.whitespace_re = re.compile('( {2,}|\t)', re.UNICODE)
-
-        # create a dict of (start, end) tuples that wrap the
-        # value of a token so that we can use it in the format
-        # method later
-        self.styles = {}
-
-        # we iterate over the `_styles` attribute of a style item
-        # that contains the parsed style values.
-        for token, style in self.style:
-            root_elem = None
-            curr_elem = None
-            # a style item is a tuple in the following form:
-            # colors are readily specified in hex: 'RRGGBB'
-            if style['color']:
-                root_elem = curr_elem = Span()
-                # pylint: disable=maybe-no-member
-                curr_elem.set_attribute(
-                  name='text:style-name',
-                  value='md2odp-TColor%s' % style['color'])
-
-            if style['bold']:
-                span = Span()
-                # pylint: disable=maybe-no-member
-                span.set_attribute(name='text:style-name',
-                                   value='md2odp-TBold')
-                if root_elem is None:
-                    root_elem = curr_elem = span
-                else:
-                    curr_elem.append(span)
-                    curr_elem = span
-
-            if style['italic']:
-                span = Span()
-                # pylint: disable=maybe-no-member
-                span.set_attribute(name='text:style-name',
-                                   value='md2odp-TItalic')
-                if root_elem is None:
-                    root_elem = curr_elem = span
-                else:
-                    curr_elem.append(span)
-                    curr_elem = span
-
-            if style['underline']:
-                span = Span()
-                # pylint: disable=maybe-no-member
-                span.set_attribute(name='text:style-name',
-                                   value='md2odp-TUnderline')
-                if root_elem is None:
-                    root_elem = curr_elem = span
+        """Get list of odf_element elements. Treat as read-only, other
+           trees may share it"""
+        if self._chunks is None:
+            return []
+        if self._chunks[0] is not None:
+            chunks = []
+            node = self._chunks
+            while node is not None:
+                chunks.append(node[1])
+                node = node[0]
+            elements = []
+            for chunk in reversed(chunks):
+                elements += chunk
+            self._chunks = (None, elements)
+        return self._chunks[1]
+
+
+# character styles of ODFFormatter's spans: one per combination of
+# color and font attributes, named md2odp-T[Color<hex>][Bold][Italic]
+# [Underline] - so the name tells the properties
+_highlight_style_name_re = re.compile(
+    r'^md2odp-T(?:Color([0-9a-fA-F]{6}))?(Bold)?(Italic)?(Underline)?$')
+_highlight_style_re = re.compile(r'text:style-name="(md2odp-T[^"]+)"')
+
+
+def _highlight_style_name(style):
+    """Name of the character style for a pygments style item, None if
+       it needs none"""
+    name = 'md2odp-T'
+    if style['color']:
+        name += 'Color' + style['color']
+    for attr in ('bold', 'italic', 'underline'):
+        if style[attr]:
+            name += attr.capitalize()
+    return name if len(name) > 8 else None
+
+
+def _highlight_style_properties(name):
+    """Text properties of highlight character style name, or None"""
+    match = _highlight_style_name_re.match(name)
+    if match is None or not any(match.groups()):
+        return None
+    color, bold, italic, underline = match.groups()
+    properties = {}
+    if color:
+        properties['color'] = '#' + color
+    if bold:
+        properties['font_weight'] = 'bold'
+    if italic:
+        properties['font_style'] = 'italic'
+    if underline:
+        properties.update(text_underline_style='solid',
+                          text_underline_width='auto',
+                          text_underline_color='font-color')
+    return [('text', properties)]
+
+
+def add_highlight_styles(document, names):
+    """Insert the autostyles highlighted code spans refer to by names
+       into document. Other names get ignored"""
+    for name in names:
+        properties = _highlight_style_properties(name)
+        if properties is not None:
+            add_style(document, 'text', name, properties)
+
+
+# autostyles of rendered tables. column styles carry their width in
+# the name, in 1/100 mm - md2odp-TableColumn<width>
+_table_styles = {
+    'md2odp-TableCellStyle': (
+        'table-cell',
+        [('paragraph', {'fo:border': '0.03cm solid #000000'}),
+         ('text', {'size': '14pt'})]),
+    'md2odp-TableHeaderCellStyle': (
+        'table-cell',
+        [('paragraph', {'fo:border': '0.03cm solid #000000'}),
+         ('graphic', {'draw:fill': 'solid', 'draw:fill_color': '#e6e6e6'}),
+         ('text', {'size': '14pt', 'font_weight': 'bold'})]),
+    'md2odp-TableParagraphLeft': (
+        'paragraph', [('paragraph', {'fo:text_align': 'start'})]),
+    'md2odp-TableParagraphCenter': (
+        'paragraph', [('paragraph', {'fo:text_align': 'center'})]),
+    'md2odp-TableParagraphRight': (
+        'paragraph', [('paragraph', {'fo:text_align': 'end'})]),
+}
+_table_column_re = re.compile(r'^md2odp-TableColumn([0-9]+)$')
+_table_style_re = re.compile(r'style-name="(md2odp-Table\w+)"')
+
+# row height model for splitting tables across slides, in cm: 14pt
+# text, about half as wide as high on average, plus the cell padding
+_table_line_height = 14 * 1.2 * 2.54 / 72
+_table_char_width = 14 * 0.5 * 2.54 / 72
+_table_cell_padding = (0.5, 0.26)
+
+
+def add_table_styles(document, names):
+    """Insert the autostyles tables refer to by names into document.
+       Other names get ignored"""
+    for name in names:
+        if name in _table_styles:
+            family, properties = _table_styles[name]
+        else:
+            match = _table_column_re.match(name)
+            if match is None:
+                continue
+            family, properties = 'table-column', [(
+                'table-column',
+                {'style:column_width': '%.2fmm' % (
+                    int(match.group(1)) / 100.0)})]
+        add_style(document, family, name, properties)
+
+
+def _copy_element(element):
+    """Deep copy of odfdo element - way cheaper than its clone property"""
+    # pylint: disable=protected-access
+    return type(element)(tag_or_elem=copy.deepcopy(element._xml_element))
+
+
+# xml -> odfdo element to copy for _new_element()
+_element_prototypes = {}
+
+
+def _new_element(xml):
+    """Same as Element.from_tag(xml), but copied from a prototype made
+       once per xml - odfdo's constructors parse xml text every time"""
+    proto = _element_prototypes.get(xml)
+    if proto is None:
+        from odfdo.element import Element
+        proto = _element_prototypes[xml] = Element.from_tag(xml)
+    return _copy_element(proto)
+
+
+def _odf_formatter_class():
+    """Define ODFFormatter, on first use - pygments.formatter is slow to
+       import, and not needed before there is code to highlight"""
+    from pygments.formatter import Formatter
+
+    # parts from http://pygments.org/docs/formatterdevelopment/, BSD
+    # license
+    class ODFFormatter(Formatter):
+        """Format pygment token stream as ODF"""
+        def __init__(self, **options):
+            from odfdo.paragraph import Span
+            Formatter.__init__(self, **options)
+
+            # buffer regex for tab/space splitting for block code
+            self.whitespace_re = re.compile('( {2,}|\t)', re.UNICODE)
+
+            # create a dict of span prototypes, carrying one character
+            # style for the combined color and font attributes of the
+            # token type (or None for no style), to clone per text run in
+            # the format method later
+            self.styles = {}
+            spans = {}
+
+            # we iterate over the `_styles` attribute of a style item
+            # that contains the parsed style values.
+            for token, style in self.style:
+                name = _highlight_style_name(style)
+                if name is not None and name not in spans:
+                    spans[name] = Span(style=name)
+                self.styles[token] = spans.get(name)
+
+        def add_style_defs(self, document):
+            """Add odf autostyles for all token types of the pygments style
+               to document. ODFRenderer only adds those a deck uses, see
+               add_highlight_styles()"""
+            add_highlight_styles(document, collections.OrderedDict.fromkeys(
+                span.get_attribute('text:style-name')
+                for span in self.styles.values() if span is not None))
+
+        def _span(self, ttype, text):
+            from odfdo.paragraph import Span
+            proto = self.styles[ttype]
+            span = Span() if proto is None else proto.clone
+            span.text = text
+            return span
+
+        def format(self, tokensource):
+            result = []
+
+            # lastval is a string we use for caching because it's possible
+            # that an lexer yields a number of consecutive tokens with the
+            # same token type.  to minimize the size of the generated
+            # markup we try to join the values of same-type tokens here
+            lastval = ''
+            lasttype = None
+
+            for ttype, value in tokensource:
+                # if the token type doesn't exist in the stylemap
+                # we try it with the parent of the token type
+                # eg: parent of Token.Literal.String.Double is
+                # Token.Literal.String
+                while ttype not in self.styles:
+                    ttype = ttype.parent
+                if ttype == lasttype:
+                    # the current token type is the same of the last
+                    # iteration. cache it
+                    lastval += value
                 else:
-                    curr_elem.append(span)
-                    curr_elem = span
-
-            self.styles[token] = (root_elem, curr_elem)
-
-    def add_style_defs(self, document):
-        """Add needed odf autostyles to document"""
-        # we iterate over the `_styles` attribute of a style item
-        # that contains the parsed style values.
-        for token, style in self.style:
-            # a style item is a tuple in the following form:
-            # colors are readily specified in hex: 'RRGGBB'
-            if style['color']:
-                add_style(document, 'text',
-                          'md2odp-TColor%s' % style['color'],
-                          [('text', {'color': '#'+style['color']})])
-            if style['bold']:
-                add_style(document, 'text', 'md2odp-TBold',
-                          [('text', {'font_weight': 'bold'})])
-            if style['italic']:
-                add_style(document, 'text', 'md2odp-TItalic',
-                          [('text', {'font_style': 'italic'})])
-            if style['underline']:
-                add_style(document, 'text', 'md2odp-TUnderline',
-                          [('text', {'text_underline_style': 'solid',
-                                     'text_underline_width': 'auto',
-                                     'text_underline_color': 'font-color'})])
-
-    def format(self, tokensource):
-        result = []
-
-        # lastval is a string we use for caching because it's possible
-        # that an lexer yields a number of consecutive tokens with the
-        # same token type.  to minimize the size of the generated
-        # markup we try to join the values of same-type tokens here
-        lastval = ''
-        lasttype = None
-
-        for ttype, value in tokensource:
-            # if the token type doesn't exist in the stylemap
-            # we try it with the parent of the token type
-            # eg: parent of Token.Literal.String.Double is
-            # Token.Literal.String
-            while ttype not in self.styles:
-                ttype = ttype.parent
-            if ttype == lasttype:
-                # the current token type is the same of the last
-                # iteration. cache it
-                lastval += value
-            else:
-                # not the same token as last iteration, but we
-                # have some data in the buffer. wrap it with the
-                # defined style and write it to the output file
-                if lastval:
-                    root_span, leaf_span = self.styles[lasttype]
-
-                    # white space and linefeeds: special handling
-                    # needed in ODF
-                    for elem in handle_whitespace(lastval):
-                        if isinstance(elem, str):
-                            if root_span is None:
-                                span = Span()
-                                span.text = elem
-                                result.append(span)
+                    # not the same token as last iteration, but we
+                    # have some data in the buffer. wrap it with the
+                    # defined style and write it to the output file
+                    if lastval:
+                        # white space and linefeeds: special handling
+                        # needed in ODF
+                        for elem in handle_whitespace(lastval):
+                            if isinstance(elem, str):
+                                result.append(self._span(lasttype, elem))
                             else:
-                                # this is nasty - set text in
-                                # shared style instance, clone
-                                # afterwards
-                                leaf_span.text = elem
-                                result.append(root_span.clone)
-                        else:
-                            result.append(elem)
-
-                # set lastval/lasttype to current values
-                lastval = value
-                lasttype = ttype
-
-        # something left in lastval? flush it now
-        if lastval:
-            root_span, leaf_span = self.styles[lasttype]
-            if root_span is None:
-                span = Span()
-                span.text = str(lastval)
-                result.append(span)
+                                result.append(elem)
+
+                    # set lastval/lasttype to current values
+                    lastval = value
+                    lasttype = ttype
+
+            # something left in lastval? flush it now
+            if lastval:
+                result.append(self._span(lasttype, str(lastval)))
+
+            return result
+
+    return ODFFormatter
+
+
+# process-wide registries, so lexers and formatter style tables get
+# set up only once per language and highlight style
+_lexers = {}
+_formatters = {}
+
+
+def get_lexer(language):
+    """Shared pygments lexer instance for language"""
+    lexer = _lexers.get(language)
+    if lexer is None:
+        # pygments.lexers only when there is code to highlight
+        from pygments.lexers import get_lexer_by_name
+        lexer = _lexers[language] = get_lexer_by_name(language)
+    return lexer
+
+
+def get_formatter(style):
+    """Shared ODFFormatter instance for pygments style name"""
+    formatter = _formatters.get(style)
+    if formatter is None:
+        formatter = _formatters[style] = _lazy_class('ODFFormatter')(
+            style=style)
+    return formatter
+
+
+class HighlightCache:
+    """Memoizes syntax-highlighted code blocks, keyed by language, code
+       and highlight style. Keeps the size most recently used blocks in
+       memory, and on disk below path, if given - least recently used
+       entries get evicted there above size_limit bytes"""
+
+    def __init__(self, size=256, path=None, size_limit=64 * 1024 * 1024):
+        self.size = size
+        self.path = path
+        self.size_limit = size_limit
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self._blocks = collections.OrderedDict()
+        if path is not None:
+            os.makedirs(path, exist_ok=True)
+
+    def _entry_path(self, key):
+        digest = hashlib.sha256(json.dumps(
+            [__version__, _cache_format, key]).encode('utf-8')).hexdigest()
+        return os.path.join(self.path, digest + '.xml')
+
+    def _load(self, key):
+        if self.path is None:
+            return None
+        from lxml import etree
+        from odfdo.element import Element
+        entry_path = self._entry_path(key)
+        try:
+            with open(entry_path, 'rb') as entry:
+                para = Element.from_tag(entry.read().decode('utf-8'))
+            # mark as recently used
+            os.utime(entry_path)
+        except (OSError, ValueError, etree.LxmlError):
+            return None
+        return para.children
+
+    def _store(self, key, elements):
+        import tempfile
+        from odfdo.paragraph import Paragraph
+        if self.path is None:
+            return
+        para = Paragraph()
+        for elem in elements:
+            para.append(elem.clone)
+        fd, tmp_path = tempfile.mkstemp(dir=self.path, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as tmp:
+            tmp.write(para.serialize().encode('utf-8'))
+        os.replace(tmp_path, self._entry_path(key))
+
+    def highlight(self, code, language, style):
+        """Return list of odf elements for code, highlighted as
+           language in given pygments style"""
+        key = (language, code, style)
+        elements = self._blocks.get(key)
+        if elements is not None:
+            self._blocks.move_to_end(key)
+            self.hits += 1
+        else:
+            elements = self._load(key)
+            if elements is not None:
+                self.disk_hits += 1
             else:
-                # this is nasty - set text in shared style instance,
-                # clone afterwards
-                leaf_span.text = str(lastval)
-                result.append(root_span.clone)
-
+                self.misses += 1
+                elements = get_formatter(style).format(
+                    get_lexer(language).get_tokens(code))
+                self._store(key, elements)
+            self._blocks[key] = elements
+            if len(self._blocks) > self.size:
+                self._blocks.popitem(last=False)
+        return [elem.clone for elem in elements]
+
+    def trim(self):
+        """Evict least recently used disk entries until below size
+           limit"""
+        if self.path is not None:
+            trim_cache_dir(self.path, self.size_limit)
+
+
+# in-memory highlight cache shared by all renderers without own one
+_highlight_cache = HighlightCache()
+
+
+def probe_image(imagedata, ext):
+    """Return (width, height) of image data, in arbitrary units"""
+    try:
+        if not ext.endswith('svg'):
+            # delay our PIL dependency until really needed
+            from PIL import Image
+
+            # obtain image aspect ratio
+            return Image.open(io.BytesIO(imagedata)).size
+        else:
+            # PIL does not really support svg, so let's try heuristics
+            # & find the aspect ratio ourselves
+            from bs4 import BeautifulSoup
+
+            imagefile = BeautifulSoup(imagedata, features='xml')
+            return (float(imagefile.svg['width']),
+                    float(imagefile.svg['height']))
+    except Exception:
+        return (100, 100)
+
+
+def load_image(src, http_cache=None):
+    """Read image from local path or url, return (imagedata, size).
+       Remote images go through http_cache, if given"""
+    parse = urllib.parse.urlparse(src)
+    if not parse.scheme and not parse.netloc:
+        with open(src, 'rb') as imagefile:
+            imagedata = imagefile.read()
+    elif http_cache is not None:
+        imagedata = http_cache.fetch(src)
+    else:
+        from urllib.request import urlopen
+        imagedata = urlopen(src).read()
+    return imagedata, probe_image(imagedata, parse[2].split('.')[-1])
+
+
+def _urlopen_get(url, headers, opener=None):
+    """Plain urllib GET, returning (status, headers, data). Goes through
+       urllib's default opener, unless another one is given"""
+    from urllib.error import HTTPError
+    from urllib.request import Request, urlopen
+    try:
+        request = Request(url, headers=headers)
+        response = (urlopen(request) if opener is None
+                    else opener.open(request))
+    except HTTPError as exc:
+        if exc.code != 304:
+            raise
+        return exc.code, exc.headers, b''
+    return response.status, response.headers, response.read()
+
+
+class RemoteImageCache:
+    """On-disk cache of remote images. Cached copies get revalidated via
+       ETag/Last-Modified conditional requests, or served as-is in
+       offline mode. Least recently used entries get evicted above
+       size_limit bytes"""
+
+    def __init__(self, path, size_limit=256 * 1024 * 1024, offline=False):
+        self.path = path
+        self.size_limit = size_limit
+        self.offline = offline
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(path, exist_ok=True)
+
+    def _entry_path(self, url):
+        return os.path.join(self.path,
+                            hashlib.sha256(url.encode('utf-8')).hexdigest())
+
+    def _load(self, url):
+        try:
+            with open(self._entry_path(url), 'rb') as entry:
+                header, data = entry.read().split(b'\n', 1)
+            return json.loads(header.decode('utf-8')), data
+        except (OSError, ValueError):
+            return None, None
+
+    def _store(self, url, response_headers, data):
+        import tempfile
+        header = {'url': url,
+                  'etag': response_headers.get('ETag'),
+                  'last_modified': response_headers.get('Last-Modified')}
+        fd, tmp_path = tempfile.mkstemp(dir=self.path, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as tmp:
+            tmp.write(json.dumps(header).encode('utf-8') + b'\n' + data)
+        os.replace(tmp_path, self._entry_path(url))
+
+    def fetch(self, url, get=_urlopen_get):
+        """Return content of url, from cache if still valid. get(url,
+           headers) does the actual request, returning (status, headers,
+           data) - and raising for errors"""
+        header, data = self._load(url)
+        if self.offline:
+            if header is None:
+                from urllib.error import URLError
+                raise URLError('offline mode, and %s not cached' % url)
+            self.hits += 1
+            return data
+
+        request_headers = {'User-Agent': 'odpdown/' + __version__}
+        if header is not None:
+            if header['etag']:
+                request_headers['If-None-Match'] = header['etag']
+            if header['last_modified']:
+                request_headers['If-Modified-Since'] = header['last_modified']
+        status, response_headers, response_data = get(url, request_headers)
+        if status == 304 and header is not None:
+            # mark as recently used
+            os.utime(self._entry_path(url))
+            self.hits += 1
+            return data
+
+        self.misses += 1
+        self._store(url, response_headers, response_data)
+        return response_data
+
+    def trim(self):
+        """Evict least recently used entries until below size limit"""
+        trim_cache_dir(self.path, self.size_limit)
+
+
+# mistune's inline image grammar, unanchored
+_image_link_re = re.compile(
+    '!' + mistune.InlineGrammar.link.pattern[len('^!?'):])
+_image_reflink_re = re.compile(
+    '!' + mistune.InlineGrammar.reflink.pattern[len('^!?'):])
+_image_nolink_re = re.compile(
+    '!' + mistune.InlineGrammar.nolink.pattern[len('^!?'):])
+_def_link_url_re = re.compile(mistune.BlockGrammar.def_links.pattern,
+                              re.MULTILINE)
+
+
+def _link_key(key):
+    # same as mistune's reference link keys
+    return re.sub(r'\s+', ' ', key.lower())
+
+
+def find_images(text):
+    """Return image sources referenced in markdown text, in order -
+       leaving out those in code"""
+    text = _code_block_re.sub('', text)
+    text = _indented_code_re.sub('', text)
+    text = _code_span_re.sub('', text)
+    links = {}
+    for match in _def_link_url_re.finditer(text):
+        links.setdefault(_link_key(match.group(1)), match.group(2))
+    sources = []
+    for match in _image_link_re.finditer(text):
+        sources.append(match.group(3))
+    for match in _image_reflink_re.finditer(text):
+        key = _link_key(match.group(2) or match.group(1))
+        if key in links:
+            sources.append(links[key])
+    for match in _image_nolink_re.finditer(text):
+        key = _link_key(match.group(1))
+        if key in links:
+            sources.append(links[key])
+    return list(collections.OrderedDict.fromkeys(sources))
+
+
+class ImagePrefetcher:
+    """Loads and probes images on a bounded thread pool ahead of
+       rendering. Remote images are fetched over one persistent http
+       connection per host and thread (or through urllib, for urls the
+       *_proxy environment variables send to a proxy), going through
+       http_cache if given. Loaded images stay around for slides using
+       them again, up to cache_size bytes, least recently used ones
+       getting dropped first"""
+
+    def __init__(self, max_workers=8, http_cache=None,
+                 cache_size=64 * 1024 * 1024):
+        import threading
+        self.max_workers = max_workers
+        self.http_cache = http_cache
+        self.cache_size = cache_size
+        self._executor = None
+        self._pending = {}
+        # src -> (imagedata, size) of images handed out already
+        self._done = collections.OrderedDict()
+        self._done_size = 0
+        self._local = threading.local()
+        self._connections = []
+        self._lock = threading.Lock()
+
+    def prefetch(self, sources):
+        """Start loading given image sources in the background"""
+        from concurrent.futures import ThreadPoolExecutor
+        for src in sources:
+            if src in self._pending or src in self._done:
+                continue
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(self.max_workers)
+            self._pending[src] = self._executor.submit(self._load, src)
+
+    def result(self, src):
+        """Return (imagedata, size) for src, same as load_image(). Load
+           errors get raised here, for the image actually needed"""
+        if src in self._done:
+            self._done.move_to_end(src)
+            return self._done[src]
+        future = self._pending.pop(src, None)
+        if future is None:
+            result = load_image(src, self.http_cache)
+        else:
+            result = future.result()
+        self._done[src] = result
+        self._done_size += len(result[0])
+        while self._done and self._done_size > self.cache_size:
+            self._done_size -= len(self._done.popitem(last=False)[1][0])
         return result
 
+    def close(self):
+        """Drop unclaimed results, close connections and thread pool"""
+        if self._executor is not None:
+            for future in self._pending.values():
+                future.cancel()
+            self._executor.shutdown(wait=True)
+            self._executor = None
+        for conn in self._connections:
+            conn.close()
+        self._connections = []
+        self._pending = {}
+        self._done.clear()
+        self._done_size = 0
+
+    def _load(self, src):
+        parse = urllib.parse.urlparse(src)
+        if parse.scheme not in ('http', 'https'):
+            return load_image(src, self.http_cache)
+        if self.http_cache is not None:
+            imagedata = self.http_cache.fetch(src, self._get)
+        else:
+            imagedata = self._get(src, {})[2]
+        return imagedata, probe_image(imagedata, parse[2].split('.')[-1])
+
+    def _get(self, url, headers, redirects=5):
+        """GET over pooled connection, returning (status, headers,
+           data)"""
+        import http.client
+        from urllib.error import HTTPError, URLError
+        from urllib.request import (ProxyHandler, build_opener, getproxies,
+                                    proxy_bypass)
+
+        parse = urllib.parse.urlsplit(url)
+        proxies = getproxies()
+        if (parse.scheme in proxies and
+                not proxy_bypass(parse.hostname or '')):
+            return _urlopen_get(url, dict(
+                {'User-Agent': 'odpdown/' + __version__}, **headers),
+                build_opener(ProxyHandler(proxies)))
+        if not hasattr(self._local, 'connections'):
+            self._local.connections = {}
+        connections = self._local.connections
+        path = urllib.parse.urlunsplit(('', '', parse.path or '/',
+                                        parse.query, ''))
+        for attempt in range(2):
+            conn = connections.get((parse.scheme, parse.netloc))
+            if conn is None:
+                conn_class = (http.client.HTTPSConnection
+                              if parse.scheme == 'https'
+                              else http.client.HTTPConnection)
+                conn = connections[(parse.scheme, parse.netloc)] = (
+                    conn_class(parse.netloc, timeout=60))
+                with self._lock:
+                    self._connections.append(conn)
+            try:
+                conn.request('GET', path, headers=dict(
+                    {'User-Agent': 'odpdown/' + __version__}, **headers))
+                response = conn.getresponse()
+                data = response.read()
+                break
+            except (OSError, http.client.HTTPException) as exc:
+                conn.close()
+                del connections[(parse.scheme, parse.netloc)]
+                # stale keep-alive connection? retry once on a new one
+                if attempt:
+                    raise URLError(exc)
+
+        if response.status in (301, 302, 303, 307, 308) and redirects:
+            return self._get(urllib.parse.urljoin(
+                url, response.getheader('Location')), headers, redirects - 1)
+        if response.status >= 400:
+            raise HTTPError(url, response.status, response.reason,
+                            response.headers, None)
+        return response.status, response.headers, data
+
+
+def _optimize_picture(job):
+    """Downscale raster image data to fit size (in pixels), and
+       recompress. Returns the original data if that is not smaller,
+       or cannot be decoded"""
+    imagedata, size, quality = job
+    from PIL import Image
+
+    output = io.BytesIO()
+    try:
+        image = Image.open(io.BytesIO(imagedata))
+        image_format = image.format
+        if image_format not in ('JPEG', 'PNG'):
+            return imagedata
+        if image.width > size[0] or image.height > size[1]:
+            image.thumbnail(size, Image.LANCZOS)
+
+        if image_format == 'JPEG':
+            image.save(output, 'JPEG', quality=quality, optimize=True,
+                       exif=image.info.get('exif', b''))
+        else:
+            image.save(output, 'PNG', optimize=True)
+    except (OSError, SyntaxError, ValueError, Image.DecompressionBombError):
+        # corrupt or truncated - keep it as it is
+        return imagedata
+    if output.tell() < len(imagedata):
+        return output.getvalue()
+    return imagedata
+
+
+# frame sizes as written by ODFRenderer.image()
+_frame_length_re = re.compile(r'^([0-9.]+)(cm|mm|in|pt|pc|px)$')
+_length_per_inch = {'cm': 2.54, 'mm': 25.4, 'in': 1.0,
+                    'pt': 72.0, 'pc': 6.0, 'px': 96.0}
+
+
+def _length_cm(length):
+    """Length in cm of an odf length string like '12.5cm', or None for
+       relative lengths like '80%'"""
+    match = _frame_length_re.match(length)
+    if match is None:
+        return None
+    return float(match.group(1)) * 2.54 / _length_per_inch[match.group(2)]
+
+
+# outline frame size, unless the template has one
+_default_outline_size = ('22cm', '12cm')
+
+
+def picture_targets(pages, dpi=150, targets=None):
+    """Largest pixel size each picture is shown at in pages, at dpi, as
+       dict of part name -> (width, height). Updates and returns
+       targets if given, e.g. to collect sizes slide by slide"""
+    if targets is None:
+        targets = {}
+    for page in pages:
+        for frame in page.get_elements('descendant-or-self::draw:frame'):
+            images = frame.get_elements('draw:image')
+            if not images:
+                continue
+            name = images[0].get_attribute('xlink:href')
+            lengths = [_frame_length_re.match(
+                frame.get_attribute(attr) or '')
+                for attr in ('svg:width', 'svg:height')]
+            if not all(lengths):
+                continue
+            size = tuple(int(math.ceil(float(length.group(1)) * dpi /
+                                       _length_per_inch[length.group(2)]))
+                         for length in lengths)
+            old_size = targets.get(name, (0, 0))
+            targets[name] = (max(size[0], old_size[0]),
+                             max(size[1], old_size[1]))
+    return targets
+
+
+def optimize_pictures(document, pages, dpi=150, quality=85, jobs=1,
+                      cache_dir=None, targets=None):
+    """Downscale and recompress raster pictures referenced from pages,
+       to the pixel size their frames need at dpi - or to targets, as
+       collected by picture_targets(), if given. Pictures used anywhere
+       else in document (e.g. template slides or master pages) stay
+       untouched. Results get cached by content hash, target size and
+       settings in cache_dir, if given.
+
+       Parts keep their names, i.e. the hash of the original picture:
+       pages referencing them may be written out already, and further
+       uses of the same source picture still find the part"""
+    import tempfile
+    from odfdo.const import ODF_STYLES
+    used_elsewhere = set()
+    for part in (document.body, document.get_part(ODF_STYLES).root):
+        for elem in part.get_elements('descendant::*[@xlink:href]'):
+            used_elsewhere.add(elem.get_attribute('xlink:href'))
+    if targets is None:
+        targets = picture_targets(pages, dpi)
+
+    keys = {}
+    optimized = {}
+    for name, size in targets.items():
+        if (name in used_elsewhere or
+                name.split('.')[-1].lower() not in ('png', 'jpg', 'jpeg')):
+            continue
+        imagedata = document.get_part(name)
+        if not imagedata:
+            continue
+        keys[name] = hashlib.sha256(json.dumps(
+            [__version__, hashlib.sha256(imagedata).hexdigest(), size,
+             quality]).encode('utf-8')).hexdigest()
+        if cache_dir is not None:
+            try:
+                entry_path = os.path.join(cache_dir, keys[name])
+                with open(entry_path, 'rb') as entry:
+                    optimized[name] = entry.read()
+                # mark as recently used
+                os.utime(entry_path)
+                continue
+            except OSError:
+                pass
+        optimized[name] = None
+
+    missing = [name for name, data in optimized.items() if data is None]
+    work = [(document.get_part(name), targets[name], quality)
+            for name in missing]
+    if jobs > 1 and len(work) > 1:
+        from concurrent.futures import ProcessPoolExecutor
+        with ProcessPoolExecutor(min(jobs, len(work))) as pool:
+            results = list(pool.map(_optimize_picture, work))
+    else:
+        results = [_optimize_picture(job) for job in work]
+
+    for name, data in zip(missing, results):
+        optimized[name] = data
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=cache_dir, suffix='.tmp')
+            with os.fdopen(fd, 'wb') as tmp:
+                tmp.write(data)
+            os.replace(tmp_path, os.path.join(cache_dir, keys[name]))
+
+    for name, data in optimized.items():
+        document.set_part(name, data)
+    return optimized
+
+
+class Template:
+    """Template presentation, analysed once: master page names,
+       placeholder geometry per master page, and the outline list
+       styles ODFRenderer clones. The analysis can persist in a sidecar
+       cache directory, keyed by the template's content hash"""
+
+    # bump when the sidecar format or the analysis changes
+    _sidecar_version = 1
+
+    def __init__(self, document, digest=None, analysis=None):
+        self.document = document
+        self.digest = digest
+        if analysis is None:
+            analysis = self._analyse(document)
+        self.master_names = analysis['master_names']
+        # master name -> presentation class -> (size, position)
+        self.placeholders = {
+            master: {cls: (tuple(size), tuple(position))
+                     for cls, (size, position) in frames.items()}
+            for master, frames in analysis['placeholders'].items()}
+        # master name -> serialized text:list-style of its outline1 style
+        self.list_styles = analysis['list_styles']
+
+    @classmethod
+    def load(cls, path, cache_dir=None):
+        """Load template from path. With cache_dir, reuse (or store) the
+           analysis from a sidecar file there"""
+        with open(path, 'rb') as template:
+            return cls.from_data(template.read(), cache_dir)
+
+    @classmethod
+    def from_data(cls, data, cache_dir=None):
+        """Load template from the bytes of an odp file, like load()"""
+        from odfdo.document import Document
+        digest = hashlib.sha256(data).hexdigest()
+        document = Document(io.BytesIO(data))
+        if cache_dir is None:
+            return cls(document, digest)
+
+        sidecar = os.path.join(cache_dir, digest + '.json')
+        try:
+            with open(sidecar, 'r', encoding='utf-8') as cached:
+                analysis = json.load(cached)
+            if analysis.get('version') == cls._sidecar_version:
+                return cls(document, digest, analysis)
+        except (OSError, ValueError):
+            pass
+        template = cls(document, digest)
+        template.save_sidecar(cache_dir)
+        return template
+
+    @classmethod
+    def _analyse(cls, document):
+        index = style_index(document)
+        placeholders = {}
+        for master_name, frames in index.placeholders.items():
+            placeholders[master_name] = {
+                attr: ((frame.get_attribute('svg:width'),
+                        frame.get_attribute('svg:height')),
+                       (frame.get_attribute('svg:x'),
+                        frame.get_attribute('svg:y')))
+                for attr, frame in frames.items()}
+
+        # list styles are not referenceable out of the presentation
+        # style, so keep the outline1 ones around for cloning
+        list_styles = {}
+        for master_name in index.master_pages:
+            style = index.get_style('presentation',
+                                    master_name + '-outline1')
+            if style is None:
+                continue
+            list_style = style.get_elements(
+                'style:graphic-properties/text:list-style[1]')
+            if list_style:
+                list_styles[master_name] = list_style[0].serialize()
+        return {'master_names': index.master_names,
+                'placeholders': placeholders,
+                'list_styles': list_styles}
+
+    def analysis(self):
+        """Json-able analysis, for passing to the constructor"""
+        return {'version': self._sidecar_version,
+                'master_names': self.master_names,
+                'placeholders': self.placeholders,
+                'list_styles': self.list_styles}
+
+    def save_sidecar(self, cache_dir):
+        """Store analysis in cache_dir, as <content hash>.json"""
+        import tempfile
+        os.makedirs(cache_dir, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=cache_dir, suffix='.tmp')
+        with os.fdopen(fd, 'w', encoding='utf-8') as tmp:
+            json.dump(self.analysis(), tmp)
+        os.replace(tmp_path, os.path.join(cache_dir, self.digest + '.json'))
+
+    def list_style(self, master):
+        """Fresh copy of master's outline list style, or None"""
+        from odfdo.element import Element
+        if master not in self.list_styles:
+            return None
+        return Element.from_tag(self.list_styles[master])
+
+    def geometry(self, break_master=None, content_master=None):
+        """Position and size of master page placeholders, as keyword
+           arguments for ODFRenderer"""
+        geometry = {}
+        frames = self.placeholders.get(break_master, {})
+        if 'title' in frames:
+            (geometry['breakheader_size'],
+             geometry['breakheader_position']) = frames['title']
+        frames = self.placeholders.get(content_master, {})
+        if 'title' in frames:
+            geometry['header_size'], geometry['header_position'] = (
+                frames['title'])
+        if 'outline' in frames:
+            geometry['outline_size'], geometry['outline_position'] = (
+                frames['outline'])
+        return geometry
+
+
+class Profiler:
+    """Collects wall and cpu time, call counts and counters (like image
+       bytes read or highlighted tokens) per conversion phase and per
+       slide. Phases nest - e.g. highlight and image time is part of
+       render time too. With cprofile set, also runs cProfile between
+       start() and stop()"""
+
+    def __init__(self, cprofile=False):
+        self.phases = collections.OrderedDict()
+        self.slides = []
+        self._slide = None
+        self._profile = None
+        self._start = self._stop = None
+        if cprofile:
+            import cProfile
+            self._profile = cProfile.Profile()
+
+    def start(self):
+        self._start = (time.perf_counter(), time.process_time())
+        if self._profile is not None:
+            self._profile.enable()
+
+    def stop(self):
+        if self._profile is not None:
+            self._profile.disable()
+        self._stop = (time.perf_counter(), time.process_time())
+
+    def _stats(self, name):
+        stats = self.phases.get(name)
+        if stats is None:
+            stats = self.phases[name] = {'calls': 0, 'wall': 0.0,
+                                         'cpu': 0.0}
+        return stats
+
+    @contextmanager
+    def phase(self, name):
+        """Time enclosed code as (one more call of) phase name"""
+        wall, cpu = time.perf_counter(), time.process_time()
+        try:
+            yield
+        finally:
+            stats = self._stats(name)
+            stats['calls'] += 1
+            stats['wall'] += time.perf_counter() - wall
+            stats['cpu'] += time.process_time() - cpu
+
+    def count(self, name, key, amount=1):
+        """Add amount to counter key of phase name, and of the slide
+           being rendered"""
+        stats = self._stats(name)
+        stats[key] = stats.get(key, 0) + amount
+        if self._slide is not None:
+            self._slide[key] = self._slide.get(key, 0) + amount
+
+    @contextmanager
+    def slide(self, chunk, source='rendered'):
+        """Time rendering of markdown chunk as one slide. Yields the
+           slide's record, to add the elements created to"""
+        match = re.search(r'^#+[ \t]*(.*?)[ \t#]*$', chunk, re.MULTILINE)
+        record = {'index': len(self.slides),
+                  'title': match.group(1) if match else None,
+                  'source': source, 'wall': 0.0, 'cpu': 0.0}
+        self.slides.append(record)
+        if source != 'rendered':
+            yield record
+            return
+        self._slide = record
+        wall, cpu = time.perf_counter(), time.process_time()
+        try:
+            with self.phase('render'):
+                yield record
+        finally:
+            self._slide = None
+            record['wall'] = time.perf_counter() - wall
+            record['cpu'] = time.process_time() - cpu
+
+    def add_elements(self, record, elements):
+        """Count odf elements of a rendered slide, children included"""
+        count = sum(len(elem.get_elements('descendant-or-self::*'))
+                    for elem in elements)
+        record['elements'] = record.get('elements', 0) + count
+        self._stats('render')['elements'] = (
+            self._stats('render').get('elements', 0) + count)
+
+    def report(self):
+        """Json-able report of everything recorded"""
+        report = {'odpdown': __version__,
+                  'phases': self.phases,
+                  'slides': self.slides}
+        if self._start is not None and self._stop is not None:
+            report['wall'] = self._stop[0] - self._start[0]
+            report['cpu'] = self._stop[1] - self._start[1]
+        return report
+
+    def write(self, path):
+        """Write json report to path, - writes to stderr"""
+        if path == '-':
+            json.dump(self.report(), sys.stderr, indent=2)
+            sys.stderr.write('\n')
+        else:
+            with open(path, 'w', encoding='utf-8') as out:
+                json.dump(self.report(), out, indent=2)
+
+    def dump_stats(self, path):
+        """Write cProfile statistics to path, for pstats or snakeviz"""
+        self._profile.dump_stats(path)
+
 
 class ODFRenderer(mistune.Renderer):
     """Render mistune event stream as ODF"""
@@ -420,10 +1566,19 @@ class ODFRenderer(mistune.Renderer):
                  outline_position=None,
                  highlight_style='colorful',
                  lax_heading_mode=False,
-                 autofit_text=True):
+                 autofit_text=True,
+                 highlight_cache=None,
+                 template=None,
+                 minimize_xml=False):
+        from odfdo.const import ODF_MANIFEST
+        from odfdo.style import Style
         mistune.Renderer.__init__(self)
-        self.formatter = ODFFormatter(style=highlight_style)
+        self.formatter = get_formatter(highlight_style)
+        self.highlight_cache = (_highlight_cache if highlight_cache is None
+                                else highlight_cache)
         self.document = document
+        # analysed template, for the list style clone below
+        self.template = Template(document) if template is None else template
         self.lax_heading_mode = lax_heading_mode
         self.doc_manifest = document.get_part(ODF_MANIFEST)
         self.break_master = 'Default' if break_master is None else break_master
@@ -438,21 +1593,38 @@ class ODFRenderer(mistune.Renderer):
                             else header_size)
         self.header_position = (('2cm', '0.5cm') if header_position is None
                                 else header_position)
-        self.outline_size = (('22cm', '12cm') if outline_size is None
+        self.outline_size = (_default_outline_size if outline_size is None
                              else outline_size)
         self.outline_position = (('2cm', '4cm') if outline_position is None
                                  else outline_position)
+        self.code_font_name = code_font_name
+        self.highlight_style = highlight_style
+        self.autofit_text = autofit_text
+        self.minimize_xml = minimize_xml
+        # sources of the images rendered so far
+        self.image_sources = []
+        # optional ImagePrefetcher to take images from
+        self.prefetcher = None
+        # optional RemoteImageCache for images not prefetched
+        self.http_cache = None
+        # optional Profiler recording highlight and image stats
+        self.profiler = None
+        # content hash -> part name of pictures in document, built lazily
+        self._pictures = None
+        # highlight styles added to document so far
+        self._code_styles = set()
+        # lxml node of the page a table filled last, if still current
+        self._table_page = None
 
         # font/char styles
-        self.document.insert_style(
+        style_index(document).insert_style(
             Style(
                 family='font-face',
                 name=code_font_name,
                 font_name=code_font_name,
                 font_family=code_font_name,
                 font_family_generic='modern',
-                font_pitch='fixed'),
-            automatic=True)
+                font_pitch='fixed'))
         add_style(document, 'text', 'md2odp-TextEmphasisStyle',
                   [('text', {'font_style': 'italic'})])
         add_style(document, 'text', 'md2odp-TextDoubleEmphasisStyle',
@@ -510,37 +1682,99 @@ class ODFRenderer(mistune.Renderer):
 
         # clone list style out of content master page (an abomination
         # this is not referenceable out of the presentation style...)
-        content_master_styles = [i for i in self.document.get_part(
-            ODF_STYLES).get_elements(
-                'descendant::style:style') if (
-                    i.get_attribute('style:name') ==
-                    self.content_master + '-outline1')]
-        if len(content_master_styles):
+        list_style = self.template.list_style(self.content_master)
+        if list_style is not None:
             # now stick that under custom name into automatic style section
-            list_style = content_master_styles[0].get_elements(
-                'style:graphic-properties/text:list-style[1]')[0].clone
             list_style.set_attribute('style:name', 'OutlineListStyle')
             list_style.family = 'presentation'
-            document.insert_style(style=list_style, automatic=True)
+            style_index(document).insert_style(list_style)
         else:
             print('WARNING: no outline list style found for '
                   'master page "%s"!' % self.content_master)
 
-        # delegate to pygments formatter for their styles
-        self.formatter.add_style_defs(document)
+    def render_options(self):
+        """Settings affecting rendered output, as json-able dict"""
+        return {'break_master': self.break_master,
+                'breakheader_size': self.breakheader_size,
+                'breakheader_position': self.breakheader_position,
+                'content_master': self.content_master,
+                'header_size': self.header_size,
+                'header_position': self.header_position,
+                'outline_size': self.outline_size,
+                'outline_position': self.outline_position,
+                'code_font_name': self.code_font_name,
+                'highlight_style': self.highlight_style,
+                'lax_heading_mode': self.lax_heading_mode,
+                'autofit_text': self.autofit_text,
+                'minimize_xml': self.minimize_xml}
+
+    def finish_slide(self, elements):
+        """Post-process the odf elements of a rendered slide, return
+           them"""
+        if not self.minimize_xml:
+            return elements
+        if self.profiler is None:
+            return minimize_elements(elements)
+        with self.profiler.phase('minimize'):
+            return minimize_elements(elements)
+
+    def picture_part(self, imagedata, ext, media_type):
+        """Return name of the picture part holding imagedata. Pictures
+           are stored under their content hash, and only once - also
+           reusing pictures the template has already"""
+        if self._pictures is None:
+            self._pictures = {}
+            for name in self.document.parts:
+                if name.startswith('Pictures/'):
+                    self._pictures.setdefault(hashlib.sha1(
+                        self.document.get_part(name)).hexdigest(), name)
+
+        digest = hashlib.sha1(imagedata).hexdigest()
+        name = self._pictures.get(digest)
+        if name is None:
+            name = self._pictures[digest] = 'Pictures/%s.%s' % (digest, ext)
+            if self.doc_manifest.get_media_type(name) is None:
+                self.doc_manifest.add_full_path(name, media_type)
+            self.document.set_part(name, imagedata)
+        return name
+
+    def drop_pictures(self, names):
+        """Remove picture parts names from the document, and forget
+           their content hash - a later use stores them anew"""
+        names = set(names)
+        for name in names:
+            self.document.del_part(name)
+        if self._pictures is not None:
+            self._pictures = dict((digest, name) for digest, name
+                                  in self._pictures.items()
+                                  if name not in names)
 
     def placeholder(self):
         return ODFPartialTree.from_metrics_provider([], self)
 
     def block_code(self, code, language=None):
+        from odfdo.paragraph import Paragraph, Span
         para = Paragraph(style='md2odp-ParagraphCodeStyle')
 
         if language is not None:
             # explicit lang given, use syntax highlighting
-            lexer = get_lexer_by_name(language)
-
-            for span in self.formatter.format(lexer.get_tokens(code)):
+            if self.profiler is not None:
+                with self.profiler.phase('highlight'):
+                    spans = self.highlight_cache.highlight(
+                        code, language, self.highlight_style)
+                self.profiler.count('highlight', 'tokens', len(spans))
+            else:
+                spans = self.highlight_cache.highlight(
+                    code, language, self.highlight_style)
+            for span in spans:
                 para.append(span)
+            # add the pygments styles this deck uses, once
+            names = set(para.xpath(
+                'descendant::text:span/@text:style-name'))
+            if not names <= self._code_styles:
+                add_highlight_styles(self.document,
+                                     sorted(names - self._code_styles))
+                self._code_styles |= names
         else:
             # no lang given, use plain monospace formatting
             for elem in handle_whitespace(code):
@@ -554,6 +1788,8 @@ class ODFRenderer(mistune.Renderer):
         return ODFPartialTree.from_metrics_provider([para], self)
 
     def header(self, text, level, raw=None):
+        from odfdo.frame import Frame
+        from odfdo.draw_page import DrawPage
         page = None
         if level == 1:
             page = DrawPage(
@@ -588,14 +1824,56 @@ class ODFRenderer(mistune.Renderer):
         else:
             raise RuntimeError('Unsupported heading level: %d' % level)
 
+        self._table_page = None
         return ODFPartialTree.from_metrics_provider([page], self)
 
+    def _continuation_page(self, page):
+        """New page continuing page - same master page and layout, and a
+           copy of its title"""
+        from odfdo.draw_page import DrawPage
+        cont = DrawPage(
+            draw_id='page1',
+            name=hasher(),
+            master_page=page.get_attribute('draw:master-page-name'),
+            presentation_page_layout=page.get_attribute(
+                'presentation:presentation-page-layout-name'))
+        for frame in page.get_elements('draw:frame'):
+            if frame.presentation_class == 'title':
+                cont.append(_copy_element(frame))
+                break
+        self._table_page = None
+        return cont
+
+    def page_continuation(self, page):
+        """New page continuing page, if a table filled it - else None"""
+        # pylint: disable=protected-access
+        if page._xml_element is not self._table_page:
+            return None
+        return self._continuation_page(page)
+
+    def _outline_cm(self):
+        """Outline width and height in cm - the default outline's, for
+           lengths in relative units"""
+        return tuple(_length_cm(length) or _length_cm(default)
+                     for length, default in zip(self.outline_size,
+                                                _default_outline_size))
+
     def quote_span(self, e):
         for el in e.children:
             el.style = 'md2odp-ParagraphQuoteStyle'
         return e
 
     def block_quote(self, text):
+        # tables do not nest - quote what is around them separately
+        elems = []
+        for is_table, run in _split_tables(text.get()) or [(False, [])]:
+            elems += run if is_table else self._quote(run)
+        return ODFPartialTree.from_metrics_provider(elems, self)
+
+    def _quote(self, elems):
+        """Quote paragraphs (and lists) for elems"""
+        from odfdo.list import List
+        from odfdo.paragraph import Paragraph, Span
         paras = []
         para = Paragraph(style='md2odp-ParagraphQuoteStyle')
         span = Span()
@@ -605,7 +1883,7 @@ class ODFRenderer(mistune.Renderer):
         para.append(span)
 
         last_para = para
-        for elem in text.get():
+        for elem in elems:
             if isinstance(elem, List):
                 paras.append(para)
                 lst = List(style='OutlineListStyle')
@@ -626,47 +1904,157 @@ class ODFRenderer(mistune.Renderer):
         last_para.append(span)
         if (len(para.children) > 0):
             paras.append(para)
-
-        # pylint: disable=maybe-no-member
-        return ODFPartialTree.from_metrics_provider(paras, self)
+        return paras
 
     def list_item(self, text):
-        item = ListItem()
-        for elem in wrap_spans(text.get()):
-            item.append(elem)
-        return ODFPartialTree.from_metrics_provider([item], self)
+        from odfdo.list import ListItem
+        # tables do not nest - they end the item, the rest goes on in
+        # another one
+        elems = []
+        for is_table, run in _split_tables(text.get()) or [(False, [])]:
+            if is_table:
+                elems += run
+                continue
+            item = ListItem()
+            for elem in wrap_spans(run):
+                item.append(elem)
+            elems.append(item)
+        return ODFPartialTree.from_metrics_provider(elems, self)
 
     def list(self, body, ordered=True):
         # TODO: reverse-engineer magic to convert outline style to
         # numbering style
-        lst = List(style='L1' if ordered else 'OutlineListStyle')
-        for elem in body.get():
-            lst.append(elem)
-        return ODFPartialTree.from_metrics_provider([lst], self)
+        from odfdo.list import List
+        # tables from the items go in between, splitting the list
+        elems = []
+        for is_table, run in _split_tables(body.get()) or [(False, [])]:
+            if is_table:
+                elems += run
+                continue
+            lst = List(style='L1' if ordered else 'OutlineListStyle')
+            for elem in run:
+                lst.append(elem)
+            elems.append(lst)
+        return ODFPartialTree.from_metrics_provider(elems, self)
 
     def paragraph(self, text):
         # images? insert as standalone frame, no inline img
+        from odfdo.frame import Frame
         if isinstance(text.get()[0], Frame):
             return text
         else:
             # yes, this seem broadly illogical. but most 'paragraphs'
             # actually end up being parts of tables, quotes, list items
             # etc, which might not always permit text:p
+            from odfdo.paragraph import Span
             span = Span()
             for elem in text.get():
                 span.append(elem)
             return ODFPartialTree.from_metrics_provider([span], self)
 
     def table(self, header, body):
-        pass
+        from odfdo.frame import Frame
+        header_row = header.get()[0]
+        rows = body.get()
+        # pylint: disable=protected-access
+        columns = len(header_row._xml_element)
+        width, available = self._outline_cm()
+        column_style = 'md2odp-TableColumn%d' % round(
+            width * 1000 / columns)
+        add_table_styles(self.document,
+                         sorted(_table_styles) + [column_style])
+
+        # split rows into parts fitting the outline area, each getting
+        # the header row
+        header_height = self._row_height(header_row, width)
+        parts = [[]]
+        heights = [header_height]
+        for row in rows:
+            height = self._row_height(row, width)
+            if parts[-1] and heights[-1] + height > available:
+                parts.append([])
+                heights.append(header_height)
+            parts[-1].append(row)
+            heights[-1] += height
+
+        frames = []
+        for index, part in enumerate(parts):
+            # odfdo's Table.append copies each row - build in lxml
+            table = _new_element('<table:table/>')
+            node = table._xml_element
+            for _ in range(columns):
+                node.append(_new_element(
+                    '<table:table-column table:style-name="%s"/>' %
+                    column_style)._xml_element)
+            node.append(header_row._xml_element if index == 0
+                        else copy.deepcopy(header_row._xml_element))
+            for row in part:
+                node.append(row._xml_element)
+            frame = Frame(size=(self.outline_size[0],
+                                '%.3fcm' % heights[index]),
+                          position=self.outline_position)
+            frame.append(table)
+            frames.append(frame)
+        # the tree puts them onto pages, see place_table()
+        return ODFPartialTree.from_metrics_provider(frames, self)
+
+    def place_table(self, page, frames):
+        """Put table frames onto pages of their own, continuing page -
+           starting on page itself, if it has nothing but a title yet.
+           Returns the new pages"""
+        pages = []
+        if len(page.children) > 1:
+            page = self._continuation_page(page)
+            pages.append(page)
+        for index, frame in enumerate(frames):
+            if index:
+                page = self._continuation_page(page)
+                pages.append(page)
+            page.append(frame)
+        # pylint: disable=protected-access
+        self._table_page = page._xml_element
+        return pages
 
     def table_row(self, content):
-        pass
+        cells = content.get()
+        # odfdo's Row.append copies each cell - build in lxml
+        row = _new_element('<table:table-row/>')
+        # pylint: disable=protected-access
+        node = row._xml_element
+        for cell in cells:
+            node.append(cell._xml_element)
+        return ODFPartialTree.from_metrics_provider([row], self)
+
+    @staticmethod
+    def _row_height(row, width):
+        """Estimated height in cm of table row, all columns sharing
+           width cm"""
+        # pylint: disable=protected-access
+        cells = row._xml_element
+        chars = max(1, int((width / len(cells) -
+                            _table_cell_padding[0]) / _table_char_width))
+        lines = 1
+        for node in cells:
+            lines = max(lines,
+                        -(-len(''.join(node.itertext())) // chars) +
+                        sum(1 for _ in node.iter(_line_break_tag)))
+        return lines * _table_line_height + _table_cell_padding[1]
 
     def table_cell(self, content, **flags):
-        pass
+        cell = _new_element(
+            '<table:table-cell table:style-name="%s"/>' % (
+                'md2odp-TableHeaderCellStyle' if flags.get('header')
+                else 'md2odp-TableCellStyle'))
+        para = _new_element(
+            '<text:p text:style-name="md2odp-TableParagraph%s"/>' % (
+                (flags.get('align') or 'left').capitalize()))
+        for elem in content.get():
+            para.append(elem)
+        cell.append(para)
+        return ODFPartialTree.from_metrics_provider([cell], self)
 
     def autolink(self, link, is_email=False):
+        from odfdo.link import Link
         text = link
         if is_email:
             link = 'mailto:%s' % link
@@ -674,12 +2062,14 @@ class ODFRenderer(mistune.Renderer):
         return ODFPartialTree.from_metrics_provider([lnk], self)
 
     def link(self, link, title, content):
+        from odfdo.link import Link
         lnk = Link(url=link,
                    text=content.get()[0].text,
                    title=str(title))
         return ODFPartialTree.from_metrics_provider([lnk], self)
 
     def codespan(self, text):
+        from odfdo.paragraph import Span
         span = Span()
         # pylint: disable=maybe-no-member
         span.set_attribute(name='text:style-name',
@@ -692,6 +2082,7 @@ class ODFRenderer(mistune.Renderer):
         return ODFPartialTree.from_metrics_provider([span], self)
 
     def double_emphasis(self, text):
+        from odfdo.paragraph import Span
         span = Span()
         # pylint: disable=maybe-no-member
         span.set_attribute(name='text:style-name',
@@ -701,6 +2092,7 @@ class ODFRenderer(mistune.Renderer):
         return ODFPartialTree.from_metrics_provider([span], self)
 
     def emphasis(self, text):
+        from odfdo.paragraph import Span
         span = Span()
         # pylint: disable=maybe-no-member
         span.set_attribute(name='text:style-name',
@@ -711,37 +2103,18 @@ class ODFRenderer(mistune.Renderer):
 
     def image(self, src, title, alt_text):
         # embed picture - TODO: optionally just link it
+        from odfdo.frame import Frame
         media_type = guess_type(src)
         parse = urllib.parse.urlparse(src)
         fragment_ext = parse[2].split('.')[-1]
-        self.image_entry_id = hasher()
-        fragment_name = 'Pictures/%s.%s' % (self.image_entry_id,
-                                            fragment_ext)
-        if not parse.scheme and not parse.netloc:
-            imagedata = open(src, 'rb').read()
+        self.image_sources.append(src)
+        if self.profiler is not None:
+            with self.profiler.phase('image'):
+                imagedata, (image_w, image_h) = self._load_image(src)
+            self.profiler.count('image', 'images')
+            self.profiler.count('image', 'image_bytes', len(imagedata))
         else:
-            imagedata = urlopen(src).read()
-
-        try:
-            if not fragment_ext.endswith('svg'):
-                # delay our PIL dependency until really needed
-                from PIL import Image
-                import io
-
-                imagefile = io.StringIO(imagedata)
-
-                # obtain image aspect ratio
-                image_w, image_h = Image.open(imagefile).size
-            else:
-                # PIL does not really support svg, so let's try heuristics
-                # & find the aspect ratio ourselves
-                from bs4 import BeautifulSoup
-
-                imagefile = BeautifulSoup(imagedata, features='xml')
-                image_w = float(imagefile.svg['width'])
-                image_h = float(imagefile.svg['height'])
-        except Exception:
-            image_w, image_h = (100, 100)
+            imagedata, (image_w, image_h) = self._load_image(src)
 
         image_ratio = image_w / float(image_h)
 
@@ -764,18 +2137,22 @@ class ODFRenderer(mistune.Renderer):
                 'presentation_class': 'graphic'}
         if title is not None:
             args['text'] = str(title)
+        fragment_name = self.picture_part(imagedata, fragment_ext,
+                                          media_type[0])
         frame = Frame.image_frame(fragment_name, **args)
 
         if alt_text is not None:
             frame.svg_description = str(alt_text)
 
-        self.doc_manifest.add_full_path(fragment_name,
-                                        media_type[0])
-        self.document.set_part(fragment_name,
-                               imagedata)
         return ODFPartialTree.from_metrics_provider([frame], self)
 
+    def _load_image(self, src):
+        if self.prefetcher is not None:
+            return self.prefetcher.result(src)
+        return load_image(src, self.http_cache)
+
     def linebreak(self):
+        from odfdo.paragraph import LineBreak
         return ODFPartialTree.from_metrics_provider([LineBreak()],
                                                     self)
 
@@ -789,18 +2166,459 @@ class ODFRenderer(mistune.Renderer):
         return text
 
 
-def main():
-    """Command-line conversion tool"""
+# markdown block syntax relevant for finding slide boundaries. mirrors
+# the respective mistune block grammar rules
+_fence_re = re.compile(r'^ *(`{3,}|~{3,})')
+_slide_heading_re = re.compile(r'^(#{1,6})(?!#)[^\n]*\S')
+_def_link_re = re.compile(
+    r'^ {0,3}\[[^^\]]+\]: *<?[^\s>]+>?(?: +["(][^\n]+[")])? *$')
+_slide_end_link = '[odpdown-slide-end]: #\n'
+
+
+def _slide_chunks(lines, lax_heading_mode=False, link_defs=None):
+    """Yield (chunk, last) for the markdown chunks starting new slides,
+       as soon as the heading of the next slide arrives. Link definition
+       lines seen so far get appended to link_defs, if given"""
+    current = []
+    fence = None
+    boundary_ok = True
+    for line in lines:
+        if fence is not None:
+            current.append(line)
+            if line.strip().startswith(fence):
+                fence = None
+                boundary_ok = True
+            continue
+
+        match = _fence_re.match(line)
+        if match:
+            fence = match.group(1)
+            current.append(line)
+            boundary_ok = False
+            continue
+
+        if link_defs is not None and _def_link_re.match(line):
+            link_defs.append(line.rstrip('\n'))
+
+        match = _slide_heading_re.match(line)
+        if (match and boundary_ok and
+                (len(match.group(1)) <= 2 or lax_heading_mode)):
+            if ''.join(current).strip():
+                yield ''.join(current), False
+            current = []
+            boundary_ok = True
+        else:
+            boundary_ok = not line.strip() or match is not None
+        current.append(line)
+
+    if ''.join(current).strip():
+        yield ''.join(current), True
+
+
+def _slide_text(chunk, last, link_defs):
+    """Make chunk render on its own like within the whole text"""
+    # mistune strips trailing newlines off its input, which changes
+    # e.g. indented code blocks at the end of a chunk. Close all but the
+    # last chunk with a (no-output) link definition instead
+    if not last:
+        chunk += _slide_end_link
+    if link_defs:
+        # prepend, so trailing blank lines of chunks stay untouched
+        chunk = '\n'.join(link_defs) + '\n\n' + chunk
+    return chunk
+
+
+def split_slides(text, lax_heading_mode=False):
+    """Split markdown text at the headings starting new slides.
+
+       Returns list of chunks that each render on their own into the
+       same odf elements as the whole text does. Chunks only start at
+       headings following a blank line, as mistune glues them onto a
+       preceding list or quote otherwise. Link definitions are copied
+       to every chunk, since references may cross slide boundaries."""
+    link_defs = []
+    chunks = list(_slide_chunks(text.splitlines(True), lax_heading_mode,
+                                link_defs))
+    return [_slide_text(chunk, last, link_defs) for chunk, last in chunks]
+
+
+# mistune's inline grammar for code and links, unanchored
+_code_block_re = re.compile(mistune.BlockGrammar.fences.pattern, re.MULTILINE)
+_indented_code_re = re.compile(mistune.BlockGrammar.block_code.pattern,
+                               re.MULTILINE)
+_code_span_re = re.compile(mistune.InlineGrammar.code.pattern[1:])
+_any_link_re = re.compile(mistune.InlineGrammar.link.pattern[1:])
+_any_reflink_re = re.compile(mistune.InlineGrammar.reflink.pattern[1:])
+_any_nolink_re = re.compile(mistune.InlineGrammar.nolink.pattern[1:])
+_def_link_key_re = re.compile(r'^ {0,3}\[([^^\]]+)\]:')
+
+
+def _reference_keys(chunk):
+    """Keys of link references chunk may use - erring on the side of
+       too many, e.g. for bracketed text"""
+    text = _code_block_re.sub('', chunk)
+    text = _code_span_re.sub('', text)
+    text = _any_link_re.sub('', text)
+    keys = set()
+    for match in _any_reflink_re.finditer(text):
+        keys.add(_link_key(match.group(2) or match.group(1)))
+    for match in _any_nolink_re.finditer(_any_reflink_re.sub('', text)):
+        keys.add(_link_key(match.group(1)))
+    return keys
+
+
+def render_iter(stream, template, renderer=None, **options):
+    """Render markdown from stream (any iterable of lines, like a file
+       or sys.stdin) slide by slide, yielding the odf elements of each
+       slide (usually one DrawPage) as soon as the next slide's heading
+       arrives.
+
+       template is a Template, or the path of one. Pages get rendered
+       into its document, by renderer if given - or a new ODFRenderer
+       taking options as keyword arguments, and master page geometry
+       from template.
+
+       Output is the same as rendering the whole text in one go. Slides
+       that may use link references not defined yet get held back
+       until the definition arrives, or the input ends."""
+    if not isinstance(template, Template):
+        template = Template.load(template)
+    if renderer is None:
+        options.setdefault('code_font_name', 'Nimbus Mono L')
+        kwargs = template.geometry(options.get('break_master'),
+                                   options.get('content_master'))
+        kwargs.update(options)
+        renderer = ODFRenderer(template.document, template=template,
+                               **kwargs)
+    mkdown = mistune.Markdown(renderer=renderer)
+
+    def render(chunk, last):
+        text = _slide_text(chunk, last, link_defs)
+        if renderer.prefetcher is not None:
+            renderer.prefetcher.prefetch(find_images(text))
+        if renderer.profiler is None:
+            return renderer.finish_slide(mkdown.render(text).get())
+        with renderer.profiler.slide(chunk) as record:
+            elements = renderer.finish_slide(mkdown.render(text).get())
+        renderer.profiler.add_elements(record, elements)
+        return elements
+
+    link_defs = []
+    seen_defs = 0
+    defined = set()
+    pending = collections.deque()
+    for chunk, last in _slide_chunks(stream, renderer.lax_heading_mode,
+                                     link_defs):
+        for line in link_defs[seen_defs:]:
+            defined.add(_link_key(_def_link_key_re.match(line).group(1)))
+        seen_defs = len(link_defs)
+        pending.append((chunk, last, _reference_keys(chunk)))
+        while pending and (pending[0][1] or pending[0][2] <= defined):
+            chunk, _, _ = pending.popleft()
+            for elem in render(chunk, not pending and last):
+                yield elem
+
+    while pending:
+        chunk, _, _ = pending.popleft()
+        for elem in render(chunk, not pending):
+            yield elem
+
+
+def default_cache_dir():
+    """Per-user default location of odpdown's on-disk caches"""
+    return os.path.join(
+        os.environ.get('XDG_CACHE_HOME',
+                       os.path.join(os.path.expanduser('~'), '.cache')),
+        'odpdown')
+
+
+def _pack_elements(elements, document, doc_manifest, image_sources):
+    """Serialize rendered odf elements, together with the pictures they
+       reference and stat info of the local image files read, into a
+       json-able dict (except for picture bytes)"""
+    parts = []
+    for elem in elements:
+        for image in elem.get_elements('descendant-or-self::draw:image'):
+            name = image.get_attribute('xlink:href')
+            data = document.get_part(name) if name else None
+            if data is not None:
+                parts.append((name, doc_manifest.get_media_type(name), data))
+    sources = []
+    for src in image_sources:
+        parse = urllib.parse.urlparse(src)
+        if not parse.scheme and not parse.netloc:
+            stat = os.stat(src)
+            sources.append((src, stat.st_mtime_ns, stat.st_size))
+    return {'elements': [elem.serialize() for elem in elements],
+            'parts': parts,
+            'sources': sources}
+
+
+def _unpack_elements(packed, document, doc_manifest):
+    """Add pictures and highlight styles of packed elements to
+       document, return odf elements"""
+    from odfdo.element import Element
+    from odfdo.draw_page import DrawPage
+    for name, media_type, data in packed['parts']:
+        if doc_manifest.get_media_type(name) is None:
+            doc_manifest.add_full_path(name, media_type)
+        document.set_part(name, data)
+    add_highlight_styles(document, sorted(set(
+        name for xml in packed['elements']
+        for name in _highlight_style_re.findall(xml))))
+    add_table_styles(document, sorted(set(
+        name for xml in packed['elements']
+        for name in _table_style_re.findall(xml))))
+    elements = [Element.from_tag(xml) for xml in packed['elements']]
+    for elem in elements:
+        if isinstance(elem, DrawPage):
+            elem.set_attribute('draw:name', str(hasher()))
+    return elements
+
+
+def trim_cache_dir(path, size_limit):
+    """Delete least recently modified files in cache directory path,
+       until the remaining ones use at most size_limit bytes"""
+    entries = []
+    total = 0
+    for entry in os.scandir(path):
+        if entry.is_file() and not entry.name.endswith('.tmp'):
+            stat = entry.stat()
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+            total += stat.st_size
+    for _, size, entry_path in sorted(entries):
+        if total <= size_limit:
+            break
+        os.unlink(entry_path)
+        total -= size
+
+
+class SlideCache:
+    """On-disk store of rendered slides, keyed by a hash of the slide's
+       markdown, the renderer options, the template's content and the
+       odpdown version. Least recently used entries get evicted above
+       size_limit bytes"""
+
+    def __init__(self, path, size_limit=256 * 1024 * 1024):
+        self.path = path
+        self.size_limit = size_limit
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(path, exist_ok=True)
+
+    @staticmethod
+    def key(chunk, options, template_digest=None):
+        """Content hash for given markdown chunk, renderer options and
+           template content hash"""
+        return hashlib.sha256(json.dumps(
+            [__version__, _cache_format, template_digest, options, chunk],
+            sort_keys=True).encode('utf-8')).hexdigest()
+
+    def _entry_path(self, key):
+        return os.path.join(self.path, key + '.zip')
+
+    def get(self, key):
+        """Return packed slide for key, None if missing or stale"""
+        import zipfile
+        path = self._entry_path(key)
+        try:
+            with zipfile.ZipFile(path) as entry:
+                index = json.loads(entry.read('index.json').decode('utf-8'))
+                for src, mtime, size in index['sources']:
+                    stat = os.stat(src)
+                    if (stat.st_mtime_ns, stat.st_size) != (mtime, size):
+                        self.misses += 1
+                        return None
+                index['parts'] = [(name, media_type, entry.read(name))
+                                  for name, media_type in index['parts']]
+        except (OSError, KeyError, ValueError, zipfile.BadZipFile):
+            self.misses += 1
+            return None
+
+        # mark as recently used
+        os.utime(path)
+        self.hits += 1
+        return index
+
+    def put(self, key, packed):
+        """Store packed slide for key"""
+        import tempfile
+        import zipfile
+        index = dict(packed)
+        index['parts'] = [(name, media_type)
+                          for name, media_type, _ in packed['parts']]
+        path = self._entry_path(key)
+        fd, tmp_path = tempfile.mkstemp(dir=self.path, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as tmp:
+            with zipfile.ZipFile(tmp, 'w', zipfile.ZIP_DEFLATED) as entry:
+                entry.writestr('index.json', json.dumps(index))
+                for name, _, data in packed['parts']:
+                    entry.writestr(name, data)
+        os.replace(tmp_path, path)
+
+    def trim(self):
+        """Evict least recently used entries until below size limit"""
+        trim_cache_dir(self.path, self.size_limit)
+
+
+# renderer of a render_slides() worker process
+_worker_markdown = None
+
+
+def _init_worker(template, options, http_cache=None, highlight_path=None):
+    """Set up renderer for worker process"""
+    global _worker_markdown
+    from odfdo.document import Document
+    highlight_cache = None
+    if highlight_path is not None:
+        highlight_cache = HighlightCache(path=highlight_path)
+    with redirect_stdout(io.StringIO()):
+        renderer = ODFRenderer(Document(template),
+                               highlight_cache=highlight_cache, **options)
+    renderer.http_cache = http_cache
+    _worker_markdown = mistune.Markdown(renderer=renderer)
+
+
+def _render_chunk(chunk):
+    """Render markdown chunk in worker process, return packed slide"""
+    renderer = _worker_markdown.renderer
+    renderer.image_sources = []
+    packed = _pack_elements(renderer.finish_slide(
+                                _worker_markdown.render(chunk).get()),
+                            renderer.document, renderer.doc_manifest,
+                            renderer.image_sources)
+    # parent takes over the pictures
+    renderer.drop_pictures(name for name, _, _ in packed['parts'])
+    return packed
+
+
+def render_slides(mkdown, text, cache=None, jobs=1, template=None):
+    """Render markdown slide by slide. Unchanged slides get reused from
+       cache if given, the others are rendered on jobs worker processes
+       (each loading template) if jobs > 1. Returns list of odf
+       elements, same as rendering the whole text in one go"""
+    return list(iter_slides(mkdown, text, cache, jobs, template))
+
+
+def iter_slides(mkdown, text, cache=None, jobs=1, template=None,
+                prefetch_all=True):
+    """Like render_slides(), but yield the odf elements of each slide
+       as soon as it is done, without keeping earlier slides alive.
+       Images get prefetched for all slides up-front, or slide by slide
+       without prefetch_all"""
+    renderer = mkdown.renderer
+    options = renderer.render_options()
+    # chunks as split_slides() returns them get built when needed only -
+    # each carries all link definitions
+    link_defs = []
+    raw_chunks = list(_slide_chunks(text.splitlines(True),
+                                    renderer.lax_heading_mode, link_defs))
+
+    def slide_text(index):
+        return _slide_text(raw_chunks[index][0], raw_chunks[index][1],
+                           link_defs)
+
+    keys = [None] * len(raw_chunks)
+    cached = [None] * len(raw_chunks)
+    if cache is not None:
+        # slides take styles and geometry from the template
+        template_digest = renderer.template.digest
+        if template_digest is None and template is not None:
+            with open(template, 'rb') as template_file:
+                template_digest = hashlib.sha256(
+                    template_file.read()).hexdigest()
+        keys = [cache.key(slide_text(index), options, template_digest)
+                for index in range(len(raw_chunks))]
+        cached = [cache.get(key) for key in keys]
+    missing = [index for index, packed in enumerate(cached)
+               if packed is None]
+
+    pool = None
+    if jobs > 1 and len(missing) > 1:
+        import multiprocessing
+        pool = multiprocessing.Pool(min(jobs, len(missing)), _init_worker,
+                                    (template, options,
+                                     renderer.http_cache,
+                                     renderer.highlight_cache.path))
+        # comes back in order, while later slides still render
+        rendered = pool.imap(_render_chunk,
+                             (slide_text(index) for index in missing))
+    elif renderer.prefetcher is not None and prefetch_all:
+        renderer.prefetcher.prefetch(find_images('\n'.join(
+            link_defs + [raw_chunks[index][0] for index in missing])))
+
+    profiler = renderer.profiler
+    try:
+        for index, (chunk, _) in enumerate(raw_chunks):
+            packed, source = cached[index], 'cache'
+            # only hold on to slides not done yet
+            cached[index] = None
+            if packed is None and pool is not None:
+                packed, source = next(rendered), 'worker'
+            if packed is not None:
+                chunk_elements = _unpack_elements(
+                    packed, renderer.document, renderer.doc_manifest)
+                if profiler is not None:
+                    with profiler.slide(chunk, source) as record:
+                        pass
+                    profiler.add_elements(record, chunk_elements)
+            else:
+                source = 'rendered'
+                renderer.image_sources = []
+                text = slide_text(index)
+                if renderer.prefetcher is not None and not prefetch_all:
+                    renderer.prefetcher.prefetch(find_images(text))
+                if profiler is not None:
+                    with profiler.slide(chunk) as record:
+                        chunk_elements = renderer.finish_slide(
+                            mkdown.render(text).get())
+                    profiler.add_elements(record, chunk_elements)
+                else:
+                    chunk_elements = renderer.finish_slide(
+                        mkdown.render(text).get())
+                if cache is not None:
+                    packed = _pack_elements(
+                        chunk_elements, renderer.document,
+                        renderer.doc_manifest, renderer.image_sources)
+            if cache is not None and source != 'cache':
+                cache.put(keys[index], packed)
+            for elem in chunk_elements:
+                yield elem
+    finally:
+        if pool is not None:
+            pool.terminate()
+
+    if cache is not None:
+        cache.trim()
+
+
+def _argument_parser(batch=False):
+    """Build the command-line parser shared by main() and the server,
+       or the one for batch mode"""
     parser = argparse.ArgumentParser(
+        prog='odpdown',
         description='Convert markdown text into OpenDocument presentations')
     parser.add_argument('--version', action='version',
                         version='%(prog)s ' + __version__)
-    parser.add_argument('input_md',
-                        help='Input markdown file')
-    parser.add_argument('template_odp',
-                        help='Input ODP template file')
-    parser.add_argument('output_odp',
-                        help='Output ODP file')
+    if batch:
+        parser.add_argument('--batch', required=True, metavar='MANIFEST',
+                            help='Convert all files listed in MANIFEST '
+                            '(one "input.md output.odp" pair per line, '
+                            'paths relative to the manifest; - reads it '
+                            'from stdin) with the same template')
+        parser.add_argument('template_odp',
+                            help='Input ODP template file')
+        parser.add_argument('pairs', nargs='*',
+                            metavar='INPUT_MD OUTPUT_ODP',
+                            help='More files to convert, in addition to '
+                            'the manifest ones')
+    else:
+        parser.add_argument('input_md',
+                            help='Input markdown file')
+        parser.add_argument('template_odp',
+                            help='Input ODP template file')
+        parser.add_argument('output_odp',
+                            help='Output ODP file')
     parser.add_argument('-p', '--page', default=-1, type=int,
                         help='Append markdown after given page. Negative '
                         'numbers count from the end of the slide stack. '
@@ -830,88 +2648,903 @@ def main():
                         help='Use this master page for the 2nd level headlines'
                         ' and content. List available ones if called with'
                         ' empty or unknown name')
-    args = parser.parse_args()
+    parser.add_argument('--slide-cache', nargs='?', const=default_cache_dir(),
+                        default=None, metavar='DIR',
+                        help='Reuse unchanged slides from previous runs, '
+                        'cached in DIR. [Defaults to %s]' %
+                        default_cache_dir())
+    parser.add_argument('--slide-cache-size', default=256, type=int,
+                        metavar='MB',
+                        help='Size limit of the slide cache, least recently'
+                        ' used slides get evicted above that. [Defaults to '
+                        '256]')
+    parser.add_argument('--highlight-cache', nargs='?',
+                        const=default_cache_dir(), default=None,
+                        metavar='DIR',
+                        help='Keep syntax-highlighted code blocks cached '
+                        'in DIR across runs. [Defaults to %s]' %
+                        default_cache_dir())
+    parser.add_argument('--highlight-cache-size', default=64, type=int,
+                        metavar='MB',
+                        help='Size limit of the highlight cache, least '
+                        'recently used blocks get evicted above that. '
+                        '[Defaults to 64]')
+    parser.add_argument('--template-cache', nargs='?',
+                        const=default_cache_dir(), default=None,
+                        metavar='DIR',
+                        help='Keep the analysis of templates (master pages, '
+                        'placeholders, list styles) cached in DIR across '
+                        'runs. [Defaults to %s]' % default_cache_dir())
+    parser.add_argument('--image-threads', default=8, type=int,
+                        metavar='N',
+                        help='Load up to N images concurrently, ahead of '
+                        'rendering. 0 loads them one by one, when needed. '
+                        '[Defaults to 8]')
+    parser.add_argument('--optimize-images', nargs='?', const=150,
+                        default=None, type=int, metavar='DPI',
+                        help='Downscale raster images to the resolution '
+                        'their slide frames need at DPI, and recompress '
+                        'them. [Defaults to 150]')
+    parser.add_argument('--image-quality', default=85, type=int,
+                        help='JPEG quality used by --optimize-images. '
+                        '[Defaults to 85]')
+    parser.add_argument('--image-cache', nargs='?',
+                        const=default_cache_dir(), default=None,
+                        metavar='DIR',
+                        help='Keep remote and optimized images cached in '
+                        'DIR across runs. [Defaults to %s]' %
+                        default_cache_dir())
+    parser.add_argument('--offline', default=False, action='store_true',
+                        help='Take remote images from the image cache only, '
+                        'never touching the network')
+    parser.add_argument('--image-cache-size', default=256, type=int,
+                        metavar='MB',
+                        help='Size limit of the image cache, least recently'
+                        ' used entries get evicted above that. [Defaults to'
+                        ' 256]')
+    if batch:
+        parser.add_argument('-j', '--jobs', default=0, type=int,
+                            help='Convert that many files at a time, on '
+                            'worker processes. 0 uses one per cpu. '
+                            '[Defaults to 0]')
+    else:
+        parser.add_argument('-j', '--jobs', default=1, type=int,
+                            help='Render slides on that many worker '
+                            'processes. 0 uses one per cpu. [Defaults '
+                            'to 1]')
+    parser.add_argument('--compression-level', default=6, type=int,
+                        choices=range(10), metavar='LEVEL',
+                        help='Deflate level (0-9) for xml and other '
+                        'compressible parts of the output. Already '
+                        'compressed images get stored. [Defaults to 6]')
+    parser.add_argument('--low-memory', default=False, action='store_true',
+                        help='Keep memory use bounded by the largest '
+                        'slide, not the size of the deck: spill finished '
+                        'slides to a temporary file right away, and load '
+                        'images slide by slide')
+    parser.add_argument('--minimize-xml', default=False,
+                        action='store_true',
+                        help='Write leaner xml for the generated slides: '
+                        'merge adjacent text runs of the same style, and '
+                        'drop redundant span wrappers')
+    parser.add_argument('--profile', default=None, metavar='FILE',
+                        help='Write a json report of time spent per phase '
+                        'and per slide to FILE (- for stderr)%s' % (
+                            ', next to each output file as '
+                            '<output>.profile.json' if batch else ''))
+    parser.add_argument('--profile-stats', default=None, metavar='FILE',
+                        help='Run the conversion under cProfile, and dump '
+                        'its statistics to FILE%s' % (
+                            ', next to each output file as <output>.prof'
+                            if batch else ''))
+    return parser
+
+
+# media formats compressed already - deflating them again only burns cpu
+_stored_extensions = frozenset((
+    'png', 'jpg', 'jpeg', 'gif', 'webp', 'tif', 'tiff', 'mp3', 'mp4', 'm4a',
+    'ogg', 'oga', 'ogv', 'webm', 'avi', 'mov', 'zip', 'gz', 'jar',
+    'odp', 'odt', 'ods', 'odg'))
+
+
+class CompressionPolicy:
+    """How save_streaming compresses package parts: media compressed
+       already gets stored, xml parts get deflated at xml_level and
+       everything else at level (0 stores). Parts of parallel_min bytes
+       or more get deflated on threads threads (None for one per cpu),
+       next to content.xml streaming in"""
+
+    def __init__(self, xml_level=6, level=6,
+                 stored_extensions=_stored_extensions, threads=None,
+                 parallel_min=64 * 1024):
+        self.xml_level = xml_level
+        self.level = level
+        self.stored_extensions = stored_extensions
+        self.threads = (os.cpu_count() or 1) if threads is None else threads
+        self.parallel_min = parallel_min
+
+    def level_for(self, name):
+        """Deflate level for part name, or None to store it"""
+        if name == 'mimetype' or name.endswith('/'):
+            return None
+        ext = name.rsplit('.', 1)[-1].lower()
+        if ext in self.stored_extensions:
+            return None
+        level = self.xml_level if ext in ('xml', 'rdf') else self.level
+        return level or None
+
+
+def _compression(level):
+    """zipfile compress_type and compresslevel for deflate level"""
+    import zipfile
+    if level is None:
+        return zipfile.ZIP_STORED, None
+    return zipfile.ZIP_DEFLATED, level
+
+
+def _deflate(data, level):
+    """Raw deflate stream of data, as zipfile writes it"""
+    import zlib
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    return compressor.compress(data) + compressor.flush()
+
+
+class _Deflated:
+    """zipfile compressor handing out data deflated beforehand"""
+
+    def __init__(self, payload):
+        self._payload = payload
+
+    def compress(self, data):
+        payload, self._payload = self._payload, b''
+        return payload
+
+    def flush(self):
+        return b''
+
+
+def _write_deflated(zip_file, name, data, payload):
+    """Add part name to zip_file, as payload deflated from data"""
+    import zipfile
+    info = zipfile.ZipInfo(name, time.localtime(time.time())[:6])
+    info.compress_type = zipfile.ZIP_DEFLATED
+    info.external_attr = 0o600 << 16
+    info.file_size = len(data)
+    with zip_file.open(info, 'w') as part:
+        # no raw writes in zipfile - it still does crc and sizes though
+        # pylint: disable=protected-access
+        part._compressor = _Deflated(payload)
+        part.write(data)
+
+
+class SlideSpool:
+    """Serialized slides, in memory up to max_size bytes and in a
+       temporary file beyond that - 0 spills right away"""
+
+    def __init__(self, max_size=16 * 1024 * 1024):
+        import tempfile
+        if max_size:
+            self._file = tempfile.SpooledTemporaryFile(max_size)
+        else:
+            self._file = tempfile.TemporaryFile()
+        self.size = 0
+
+    def write(self, data):
+        """Add serialized slide"""
+        self.size += len(data)
+        self._file.write(data)
+
+    def chunks(self):
+        """Spooled slides, as chunks of bytes"""
+        self._file.seek(0)
+        return iter(lambda: self._file.read(1024 * 1024), b'')
+
+    def close(self):
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def _package_parts(document):
+    """Part names of document, in the order odfdo writes them"""
+    from odfdo.const import ODF_MANIFEST
+    names = document.get_parts()
+    first = ['mimetype', 'content.xml', 'meta.xml', 'settings.xml',
+             'styles.xml']
+    last = [ODF_MANIFEST]
+    return ([name for name in first if name in names] +
+            [name for name in names if name not in first + last] +
+            [name for name in last if name in names])
+
+
+def _stamp_version(document):
+    """Set office:version to odfdo's, as Document.save() does"""
+    from odfdo.const import ODF_MANIFEST, OFFICE_VERSION
+    names = document.get_parts()
+    for name in ('content.xml', 'meta.xml', 'settings.xml', 'styles.xml'):
+        if name in names:
+            document.get_part(name).root.set_attribute('office:version',
+                                                       OFFICE_VERSION)
+    # manifest:version needs to match
+    manifest = document.get_part(ODF_MANIFEST).root
+    manifest.set_attribute('manifest:version', OFFICE_VERSION)
+    root_entry = manifest.get_element(
+        "manifest:file-entry[@manifest:full-path='/']")
+    if root_entry is not None:
+        root_entry.set_attribute('manifest:version', OFFICE_VERSION)
+
+
+def save_streaming(document, target, pages=(), position=None,
+                   compression=None, spool_size=16 * 1024 * 1024,
+                   before_write=None):
+    """Save document to target (path or file object), with pages (any
+       iterable of DrawPages, e.g. from render_iter) inserted at
+       position among its body children - or after its last slide, if
+       position is None.
+
+       Other than inserting pages and calling document.save(), this
+       serializes slides one at a time as pages come in, into a
+       SlideSpool holding up to spool_size bytes in memory (0 spills to
+       a temporary file right away). Peak memory is thus
+       bounded by the largest slide, not the whole deck. pages are not
+       kept in document. before_write, if given, gets called once all
+       pages are in, before any part gets written. Parts get compressed
+       as the CompressionPolicy compression says (defaults if None)."""
+    import zipfile
+    policy = CompressionPolicy() if compression is None else compression
+    body = document.body
+    existing = list(body.children)
+    if position is None:
+        # presentation:settings and the like stay behind the slides
+        tags = [child.tag for child in existing]
+        if 'draw:page' in tags:
+            position = len(tags) - tags[::-1].index('draw:page')
+        elif 'presentation:settings' in tags:
+            position = tags.index('presentation:settings')
+        else:
+            position = len(tags)
+
+    with SlideSpool(spool_size) as spool:
+        def write_page(page):
+            spool.write(page.serialize().encode('utf-8'))
+
+        for page in existing[:position]:
+            write_page(page)
+        for page in pages:
+            # serialize in place, for the document's namespaces
+            body.append(page)
+            write_page(page)
+            body.delete(page)
+        for page in existing[position:]:
+            write_page(page)
+        if before_write is not None:
+            before_write()
+
+        document.meta.set_generator_default()
+        _stamp_version(document)
+
+        # serialize content.xml, marking where the slides go
+        marker = 'odpdown-slides-%s' % uuid4().hex
+        body_text = body.text
+        for page in existing:
+            body.delete(page)
+        body.text = (body_text or '') + marker
+        try:
+            content = document.get_part('content.xml').serialize()
+        finally:
+            body.text = body_text
+            for page in existing:
+                body.append(page)
+        head, tail = content.split(marker.encode('utf-8'), 1)
+        size = len(head) + spool.size + len(tail)
+
+        # deflate large parts on threads meanwhile - zlib drops the gil
+        parts = []
+        for name in _package_parts(document):
+            if name == 'content.xml':
+                parts.append((name, None, None))
+                continue
+            data = document.get_part(name)
+            if hasattr(data, 'serialize'):
+                data = data.serialize()
+            parts.append((name, data, policy.level_for(name)))
+        large = [(name, data, level) for name, data, level in parts
+                 if level is not None and len(data) >= policy.parallel_min]
+        pool = None
+        deflated = {}
+        if policy.threads > 1 and large:
+            from concurrent.futures import ThreadPoolExecutor
+            pool = ThreadPoolExecutor(min(policy.threads, len(large)))
+            deflated = {name: pool.submit(_deflate, data, level)
+                        for name, data, level in large}
+
+        compress_type, compresslevel = _compression(
+            policy.level_for('content.xml'))
+        try:
+            with _open_output(target) as output, zipfile.ZipFile(
+                    output, 'w', compress_type,
+                    compresslevel=compresslevel) as zip_file:
+                for name, data, level in parts:
+                    if name == 'content.xml':
+                        # streamed in, zip64 if it might need it
+                        zip64 = size * 1.05 > zipfile.ZIP64_LIMIT
+                        with zip_file.open(name, 'w',
+                                           force_zip64=zip64) as part:
+                            part.write(head)
+                            for chunk in spool.chunks():
+                                part.write(chunk)
+                            part.write(tail)
+                    elif name in deflated:
+                        _write_deflated(zip_file, name, data,
+                                        deflated[name].result())
+                    else:
+                        compress_type, compresslevel = _compression(level)
+                        zip_file.writestr(name, data, compress_type,
+                                          compresslevel)
+        finally:
+            if pool is not None:
+                pool.shutdown(cancel_futures=True)
+
+
+@contextmanager
+def _open_output(target):
+    """Open target path for writing, or pass file object through"""
+    if hasattr(target, 'write'):
+        yield target
+    else:
+        with open(target, 'wb') as output:
+            yield output
+
+
+def _template_cache_dir(args):
+    if args.template_cache is None:
+        return None
+    return os.path.join(args.template_cache, 'templates')
+
+
+def convert(args, stdin_text=None, templates=None):
+    """Run one conversion for parsed command-line args.
+
+       stdin_text replaces sys.stdin for an input_md of '-'. templates
+       optionally maps absolute template paths to (mtime, Template)
+       pairs loaded beforehand - the documents get modified in place,
+       so only pass those to a process owning a private copy (like a
+       forked server worker)."""
+    if args.profile is None and args.profile_stats is None:
+        return _convert(args, stdin_text, templates)
+
+    profiler = Profiler(cprofile=args.profile_stats is not None)
+    profiler.start()
+    try:
+        return _convert(args, stdin_text, templates, profiler)
+    finally:
+        profiler.stop()
+        if args.profile is not None:
+            profiler.write(args.profile)
+        if args.profile_stats is not None:
+            profiler.dump_stats(args.profile_stats)
+
 
+def _no_phase(name):
+    return nullcontext()
+
+
+def _convert(args, stdin_text, templates, profiler=None):
+    phase = _no_phase if profiler is None else profiler.phase
     if args.input_md == '-':
-        markdown = io.TextIOWrapper(sys.stdin.buffer, encoding='utf-8')
+        if stdin_text is not None:
+            markdown = io.StringIO(stdin_text)
+        else:
+            markdown = io.TextIOWrapper(sys.stdin.buffer, encoding='utf-8')
     else:
         markdown = codecs.open(args.input_md, 'rb', encoding='utf-8')
-    presentation = Document(args.template_odp)
 
-    master_pages = presentation.get_part(ODF_STYLES).get_elements(
-        'descendant::style:master-page')
-    master_names = [i.get_attribute('style:name') for i in master_pages]
+    template = None
+    if templates is not None:
+        template_path = os.path.abspath(args.template_odp)
+        if template_path in templates:
+            mtime, template = templates[template_path]
+            if mtime != os.stat(template_path).st_mtime:
+                template = None
+    if template is None:
+        with phase('template'):
+            template = Template.load(args.template_odp,
+                                     _template_cache_dir(args))
+    presentation = template.document
+
     if ((args.break_master is not None and
-         args.break_master not in master_names) or
+         args.break_master not in template.master_names) or
         (args.content_master is not None and
-         args.content_master not in master_names)):
+         args.content_master not in template.master_names)):
 
         print(_master_page_spew + '\n')
-        for i in master_names:
+        for i in template.master_names:
             print(' - ' + i)
         return
 
-    breakheader_size = None
-    breakheader_position = None
-    header_size = None
-    header_position = None
-    outline_size = None
-    outline_position = None
-
-    # extract position and size of master page placeholders
-    for page in master_pages:
-        master_name = page.get_attribute('style:name')
-        if master_name == args.break_master:
-            frames = page.get_elements('descendant::draw:frame')
-            for frame in frames:
-                attr = frame.get_attribute('presentation:class')
-                if attr is not None and attr == 'title':
-                    breakheader_size = (frame.get_attribute('svg:width'),
-                                        frame.get_attribute('svg:height'))
-                    breakheader_position = (frame.get_attribute('svg:x'),
-                                            frame.get_attribute('svg:y'))
-        elif master_name == args.content_master:
-            frames = page.get_elements('descendant::draw:frame')
-            for frame in frames:
-                attr = frame.get_attribute('presentation:class')
-                if attr is not None and attr == 'title':
-                    header_size = (frame.get_attribute('svg:width'),
-                                   frame.get_attribute('svg:height'))
-                    header_position = (frame.get_attribute('svg:x'),
-                                       frame.get_attribute('svg:y'))
-                elif attr is not None and attr == 'outline':
-                    outline_size = (frame.get_attribute('svg:width'),
-                                    frame.get_attribute('svg:height'))
-                    outline_position = (frame.get_attribute('svg:x'),
-                                        frame.get_attribute('svg:y'))
-
-    odf_renderer = ODFRenderer(presentation,
-                               code_font_name=str(args.code_font_name),
-                               break_master=args.break_master,
-                               breakheader_size=breakheader_size,
-                               breakheader_position=breakheader_position,
-                               content_master=args.content_master,
-                               header_size=header_size,
-                               header_position=header_position,
-                               outline_size=outline_size,
-                               outline_position=outline_position,
-                               autofit_text=args.no_autofit,
-                               highlight_style=args.highlight_style,
-                               lax_heading_mode=args.lax_heading_mode)
+    highlight_cache = None
+    if args.highlight_cache is not None:
+        highlight_cache = HighlightCache(
+            path=os.path.join(args.highlight_cache, 'highlight'),
+            size_limit=args.highlight_cache_size * 1024 * 1024)
+
+    with phase('renderer'):
+        odf_renderer = ODFRenderer(presentation,
+                                   code_font_name=str(args.code_font_name),
+                                   highlight_cache=highlight_cache,
+                                   break_master=args.break_master,
+                                   content_master=args.content_master,
+                                   autofit_text=args.no_autofit,
+                                   highlight_style=args.highlight_style,
+                                   lax_heading_mode=args.lax_heading_mode,
+                                   template=template,
+                                   minimize_xml=args.minimize_xml,
+                                   **template.geometry(args.break_master,
+                                                       args.content_master))
+    odf_renderer.profiler = profiler
     mkdown = mistune.Markdown(renderer=odf_renderer)
 
     doc_elems = presentation.body
     if args.page < 0:
         args.page = len(doc_elems.children) + args.page
 
-    pages = mkdown.render(markdown.read())
-    if isinstance(pages, ODFPartialTree):
-        # pylint: disable=maybe-no-member
-        for index, page in enumerate(pages.get()):
-            doc_elems.insert(page, position=args.page + index)
+    http_cache = None
+    if args.image_cache is not None or args.offline:
+        http_cache = odf_renderer.http_cache = RemoteImageCache(
+            os.path.join(args.image_cache or default_cache_dir(), 'http'),
+            args.image_cache_size * 1024 * 1024, offline=args.offline)
+    prefetcher = None
+    if args.image_threads > 0:
+        prefetcher = odf_renderer.prefetcher = ImagePrefetcher(
+            args.image_threads, http_cache)
+
+    jobs = args.jobs or os.cpu_count()
+    try:
+        if args.slide_cache is not None or jobs > 1:
+            cache = None
+            if args.slide_cache is not None:
+                cache = SlideCache(os.path.join(args.slide_cache, 'slides'),
+                                   args.slide_cache_size * 1024 * 1024)
+            pages = iter_slides(mkdown, markdown.read(), cache=cache,
+                                jobs=jobs, template=args.template_odp,
+                                prefetch_all=not args.low_memory)
+        elif args.input_md == '-' and stdin_text is None:
+            # input may still be in the making - render slides as they
+            # come in
+            pages = render_iter(markdown, template, renderer=odf_renderer)
+        else:
+            text = markdown.read()
+            if prefetcher is not None and not args.low_memory:
+                prefetcher.prefetch(find_images(text))
+            pages = render_iter(text.splitlines(True), template,
+                                renderer=odf_renderer)
+
+        if profiler is not None:
+            # render all up-front, so saving gets timed on its own
+            pages = list(pages)
+
+        before_write = None
+        if args.optimize_images is not None:
+            # note picture sizes as slides pass by, optimize once all
+            # are in
+            targets = {}
+
+            def track_targets(pages):
+                for page in pages:
+                    picture_targets([page], args.optimize_images, targets)
+                    yield page
+
+            def optimize():
+                cache_dir = None
+                if args.image_cache is not None:
+                    cache_dir = os.path.join(args.image_cache, 'optimized')
+                with phase('optimize'):
+                    optimize_pictures(presentation, (),
+                                      dpi=args.optimize_images,
+                                      quality=args.image_quality,
+                                      jobs=jobs, cache_dir=cache_dir,
+                                      targets=targets)
+                if cache_dir is not None:
+                    trim_cache_dir(cache_dir,
+                                   args.image_cache_size * 1024 * 1024)
+            pages = track_targets(pages)
+            before_write = optimize
+
+        # pages rendered on the fly get written out one by one
+        with phase('save'):
+            save_streaming(presentation, args.output_odp, pages,
+                           position=args.page,
+                           compression=CompressionPolicy(
+                               xml_level=args.compression_level,
+                               level=args.compression_level),
+                           spool_size=0 if args.low_memory
+                           else 16 * 1024 * 1024,
+                           before_write=before_write)
+    finally:
+        if prefetcher is not None:
+            prefetcher.close()
+        if http_cache is not None:
+            http_cache.trim()
+        if highlight_cache is not None:
+            highlight_cache.trim()
+
+
+def load_template(path, cache_dir=None):
+    """Load template fully into memory, for keeping it warm across
+       conversions. Returns (mtime, Template) tuple"""
+    from odfdo.const import ODF_MANIFEST
+    path = os.path.abspath(path)
+    mtime = os.stat(path).st_mtime
+    template = Template.load(path, cache_dir)
+    # parse the remaining xml parts we need up-front
+    template.document.get_part(ODF_MANIFEST)
+    template.document.body
+    return mtime, template
+
+
+def _read_manifest(manifest):
+    """Parse batch manifest file object into (input, output) pairs.
+       Blank lines and lines starting with # get skipped, relative paths
+       are relative to the manifest"""
+    import shlex
+    base = os.path.dirname(getattr(manifest, 'name', ''))
+    if base.startswith('<'):
+        base = ''
+    pairs = []
+    for number, line in enumerate(manifest, 1):
+        if not line.strip() or line.lstrip().startswith('#'):
+            continue
+        fields = shlex.split(line)
+        if len(fields) != 2:
+            raise ValueError('%s:%d: expected input and output file, got '
+                             '%r' % (getattr(manifest, 'name', 'manifest'),
+                                     number, line.strip()))
+        pairs.append(tuple(os.path.join(base, field) for field in fields))
+    return pairs
+
+
+# template of a batch() worker process - (odp bytes, digest, analysis)
+_batch_template = None
+
+
+def _init_batch_worker(data, digest, analysis):
+    """Keep template for batch worker process"""
+    global _batch_template
+    _batch_template = (data, digest, analysis)
+
+
+def _convert_batch_job(job):
+    """Convert one file of a batch, on a fresh copy of the template.
+       Returns (input, output, seconds, error), error being None or a
+       traceback string"""
+    import traceback
+    from odfdo.document import Document
+    args, input_md, output_odp = job
+    args = argparse.Namespace(**vars(args))
+    args.input_md = input_md
+    args.output_odp = output_odp
+    args.jobs = 1
+    if args.profile is not None:
+        args.profile = output_odp + '.profile.json'
+    if args.profile_stats is not None:
+        args.profile_stats = output_odp + '.prof'
+    data, digest, analysis = _batch_template
+    start = time.perf_counter()
+    error = None
+    try:
+        template = Template(Document(io.BytesIO(data)), digest, analysis)
+        with redirect_stdout(io.StringIO()):
+            convert(args, templates={
+                os.path.abspath(args.template_odp):
+                    (os.stat(args.template_odp).st_mtime, template)})
+    except Exception:
+        error = traceback.format_exc()
+    return input_md, output_odp, time.perf_counter() - start, error
+
+
+def batch(argv):
+    """Convert many files against one template. The template gets
+       loaded and analysed once, the files converted on a pool of worker
+       processes. Failing files get reported, but don't stop the
+       others. Returns exit status"""
+    parser = _argument_parser(batch=True)
+    args = parser.parse_args(argv)
+    if len(args.pairs) % 2:
+        parser.error('input and output files must come in pairs')
+    try:
+        if args.batch == '-':
+            pairs = _read_manifest(sys.stdin)
+        else:
+            with open(args.batch, encoding='utf-8') as manifest:
+                pairs = _read_manifest(manifest)
+    except (OSError, ValueError) as exc:
+        parser.error(str(exc))
+    pairs.extend(zip(args.pairs[::2], args.pairs[1::2]))
+
+    with open(args.template_odp, 'rb') as template_file:
+        data = template_file.read()
+    template = Template.from_data(data, _template_cache_dir(args))
+    if ((args.break_master is not None and
+         args.break_master not in template.master_names) or
+        (args.content_master is not None and
+         args.content_master not in template.master_names)):
+        print(_master_page_spew + '\n')
+        for i in template.master_names:
+            print(' - ' + i)
+        return 1
+
+    initargs = (data, template.digest, template.analysis())
+    jobs = [(args, input_md, output_odp) for input_md, output_odp in pairs]
+    workers = min(args.jobs or os.cpu_count(), len(jobs))
+    start = time.perf_counter()
+    failed = 0
+    pool = None
+    if workers > 1:
+        import multiprocessing
+        pool = multiprocessing.Pool(workers, _init_batch_worker, initargs)
+        results = pool.imap(_convert_batch_job, jobs)
+    else:
+        _init_batch_worker(*initargs)
+        results = map(_convert_batch_job, jobs)
+    try:
+        for input_md, output_odp, seconds, error in results:
+            if error is None:
+                print('ok      %7.2fs  %s -> %s' % (
+                    seconds, input_md, output_odp))
+            else:
+                failed += 1
+                print('FAILED  %7.2fs  %s: %s' % (
+                    seconds, input_md, error.strip().splitlines()[-1]))
+                sys.stderr.write('%s:\n%s' % (input_md, error))
+            sys.stdout.flush()
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    print('%d converted, %d failed in %.2fs' % (
+        len(jobs) - failed, failed, time.perf_counter() - start))
+    return 1 if failed else 0
+
+
+def _private_socket_dir():
+    """Per-user directory for the socket, when there's no runtime dir"""
+    import tempfile
+    return os.path.join(tempfile.gettempdir(), 'odpdown-%d' % os.getuid())
+
+
+def default_socket_path():
+    """Per-user default location of the conversion server socket - in
+       $XDG_RUNTIME_DIR, else in a private directory under tmp"""
+    runtime_dir = os.environ.get('XDG_RUNTIME_DIR')
+    if not runtime_dir:
+        runtime_dir = _private_socket_dir()
+    return os.path.join(runtime_dir, 'odpdown-%d.sock' % os.getuid())
+
+
+def _recv_all(sock):
+    """Read from sock until the other side shuts down writing"""
+    data = []
+    while True:
+        chunk = sock.recv(65536)
+        if not chunk:
+            return b''.join(data)
+        data.append(chunk)
+
+
+def _conversion_server_class():
+    """Define ConversionServer, on first use - so that nothing but the
+       server imports socketserver"""
+    import socketserver
+    import traceback
+
+    class _ConversionHandler(socketserver.BaseRequestHandler):
+        """Run one job in a forked worker, send back output and status"""
+
+        def handle(self):
+            # read in the worker, so slow clients hold up no one else
+            self.request.settimeout(60)
+            job = json.loads(_recv_all(self.request).decode('utf-8'))
+            stdout = io.StringIO()
+            stderr = io.StringIO()
+            status = 0
+            with redirect_stdout(stdout), redirect_stderr(stderr):
+                try:
+                    os.chdir(job['cwd'])
+                    convert(_argument_parser().parse_args(job['argv']),
+                            stdin_text=job.get('stdin'),
+                            templates=self.server.templates)
+                except SystemExit as exc:
+                    status = 0 if exc.code is None else exc.code
+                except Exception:
+                    traceback.print_exc()
+                    status = 1
+            self.server.report_job(job)
+            self.request.sendall(json.dumps(
+                {'status': status,
+                 'stdout': stdout.getvalue(),
+                 'stderr': stderr.getvalue()}).encode('utf-8'))
+
+    class ConversionServer(socketserver.ForkingMixIn,
+                           socketserver.UnixStreamServer):
+        """Conversion server on a unix socket. Keeps templates parsed in
+           memory, and forks a copy-on-write worker per job"""
+
+        def __init__(self, socket_path, template_paths=()):
+            self.templates = {}
+            for path in template_paths:
+                self.templates[os.path.abspath(path)] = load_template(path)
+            # workers pass the jobs they ran back through this pipe, for
+            # the server to keep their templates warm
+            self._warm_read, self._warm_write = os.pipe()
+            os.set_blocking(self._warm_read, False)
+            self._warm_pending = b''
+            socketserver.UnixStreamServer.__init__(self, socket_path,
+                                                   _ConversionHandler)
+
+        def server_bind(self):
+            # jobs run with our rights - only let the owner connect. Bind
+            # under a tight umask, so there's no window before the chmod
+            umask = os.umask(0o177)
+            try:
+                socketserver.UnixStreamServer.server_bind(self)
+            finally:
+                os.umask(umask)
+            os.chmod(self.server_address, 0o600)
+
+        def warm_template(self, job):
+            """Load (or reload, if changed on disk) the template the job
+               uses, so it stays warm for later jobs"""
+            try:
+                with redirect_stderr(io.StringIO()):
+                    args = _argument_parser().parse_args(job['argv'])
+                path = os.path.abspath(os.path.join(job['cwd'],
+                                                    args.template_odp))
+                mtime = os.stat(path).st_mtime
+                if self.templates.get(path, (None,))[0] != mtime:
+                    self.templates[path] = load_template(
+                        path, _template_cache_dir(args))
+            except (SystemExit, Exception):
+                # worker will report the problem to the client
+                pass
+
+        def report_job(self, job):
+            """Called in the worker: have the server warm job's template"""
+            os.write(self._warm_write, json.dumps(
+                {'argv': job['argv'], 'cwd': job['cwd']}).encode('utf-8') +
+                b'\n')
+
+        def service_actions(self):
+            """Warm the templates workers reported, between requests"""
+            socketserver.ForkingMixIn.service_actions(self)
+            try:
+                self._warm_pending += os.read(self._warm_read, 65536)
+            except BlockingIOError:
+                return
+            *lines, self._warm_pending = self._warm_pending.split(b'\n')
+            for line in lines:
+                self.warm_template(json.loads(line.decode('utf-8')))
+
+        def server_close(self):
+            socketserver.UnixStreamServer.server_close(self)
+            os.close(self._warm_read)
+            os.close(self._warm_write)
+
+    return ConversionServer
+
+
+_lazy_classes = {'ConversionServer': _conversion_server_class,
+                 'ODFFormatter': _odf_formatter_class}
+
+
+def _lazy_class(name):
+    """Class from _lazy_classes, defined once on first use"""
+    cls = globals().get(name)
+    if cls is None:
+        cls = globals()[name] = _lazy_classes[name]()
+    return cls
+
+
+def __getattr__(name):
+    """Classes deriving from modules too slow to import on startup"""
+    if name not in _lazy_classes:
+        raise AttributeError('module %r has no attribute %r' % (
+            __name__, name))
+    return _lazy_class(name)
+
+
+def serve(argv):
+    """Run conversion server until interrupted"""
+    import signal
+    parser = argparse.ArgumentParser(
+        prog='odpdown serve',
+        description='Serve conversions on a unix socket. Point clients '
+        'at it via the ODPDOWN_SOCKET environment variable')
+    parser.add_argument('-S', '--socket', default=default_socket_path(),
+                        help='Socket path to listen on. [Defaults to %s]' %
+                        default_socket_path())
+    parser.add_argument('templates', nargs='*',
+                        help='ODP templates to preload')
+    args = parser.parse_args(argv)
+
+    socket_dir = os.path.dirname(os.path.abspath(args.socket))
+    if socket_dir == _private_socket_dir():
+        try:
+            os.mkdir(socket_dir, 0o700)
+        except FileExistsError:
+            pass
+        info = os.lstat(socket_dir)
+        if (not stat.S_ISDIR(info.st_mode) or
+                info.st_uid != os.getuid() or info.st_mode & 0o077):
+            parser.error('%s is not a private directory' % socket_dir)
+    try:
+        info = os.lstat(args.socket)
+    except FileNotFoundError:
+        pass
+    else:
+        # only clear away a stale socket, never anything else
+        if not stat.S_ISSOCK(info.st_mode):
+            parser.error('%s exists and is not a socket' % args.socket)
+        os.unlink(args.socket)
+    server = _lazy_class('ConversionServer')(args.socket, args.templates)
+    print('odpdown serving on %s' % args.socket)
+    sys.stdout.flush()
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        os.unlink(args.socket)
+    return 0
+
+
+def _run_remote(socket_path, argv, args):
+    """Hand conversion over to server at socket_path. Returns exit
+       status, or None if no server is listening"""
+    import socket
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        client.connect(socket_path)
+    except OSError:
+        client.close()
+        return None
+    # only now take stdin, so a local fallback still gets it
+    job = {'argv': argv, 'cwd': os.getcwd()}
+    if args.input_md == '-':
+        job['stdin'] = sys.stdin.buffer.read().decode('utf-8')
+    with client:
+        client.sendall(json.dumps(job).encode('utf-8'))
+        client.shutdown(socket.SHUT_WR)
+        data = _recv_all(client)
+    result = json.loads(data.decode('utf-8'))
+    sys.stdout.write(result['stdout'])
+    sys.stderr.write(result['stderr'])
+    return result['status']
+
+
+def main(argv=None):
+    """Command-line conversion tool"""
+    argv = sys.argv[1:] if argv is None else argv
+    if argv[:1] == ['serve']:
+        return serve(argv[1:])
+    if any(arg == '--batch' or arg.startswith('--batch=') for arg in argv):
+        return batch(argv)
+
+    args = _argument_parser().parse_args(argv)
+    socket_path = os.environ.get('ODPDOWN_SOCKET')
+    if socket_path:
+        status = _run_remote(socket_path, argv, args)
+        if status is not None:
+            return status
 
-        presentation.save(target=args.output_odp, pretty=False)
+    convert(args)
+    return 0
 
 
 if __name__ == "__main__":
-    main()
+    sys.exit(main())
@@ -36,15 +36,70 @@
 import odpdown
 import mistune
 import codecs
+import http.server
+import io
+import json
+import os
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import urllib.parse
+import zipfile
 from odfdo.const import ODF_MANIFEST
 from odfdo.document import Document
+from odfdo.element import Element
 from odfdo.draw_page import DrawPage
 from nose.tools import with_setup, raises
+from urllib.error import HTTPError, URLError
 
 testdoc = None
 odf_renderer = None
 mkdown = None
 
+_http_connections = []
+_http_statuses = []
+
+
+class _ImageRequestHandler(http.server.SimpleHTTPRequestHandler):
+    """Serves cramtest/ over keep-alive http, counting connections and
+       recording response codes"""
+    protocol_version = 'HTTP/1.1'
+
+    def __init__(self, *args, **kwargs):
+        http.server.SimpleHTTPRequestHandler.__init__(
+            self, *args, directory='cramtest', **kwargs)
+
+    def setup(self):
+        http.server.SimpleHTTPRequestHandler.setup(self)
+        _http_connections.append(self.client_address)
+
+    def send_response(self, code, message=None):
+        _http_statuses.append(code)
+        http.server.SimpleHTTPRequestHandler.send_response(
+            self, code, message)
+
+    def translate_path(self, path):
+        # requests to us as a proxy carry absolute urls
+        return http.server.SimpleHTTPRequestHandler.translate_path(
+            self, urllib.parse.urlsplit(path).path)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_image_server():
+    """Start local stand-in for remote image hosts, return base url"""
+    del _http_connections[:]
+    del _http_statuses[:]
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0),
+                                             _ImageRequestHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, 'http://127.0.0.1:%d/' % server.server_address[1]
+
 
 def setup():
     global testdoc, odf_renderer, mkdown
@@ -281,7 +336,7 @@ fi
 ~~~
 '''.strip()
     odf = mkdown.render(markdown)
-    assert odf.get()[0].get_elements('descendant::text:span')[8].text == '-eq'
+    assert odf.get()[0].get_elements('descendant::text:span')[7].text == '-eq'
 
 
 @with_setup(setup)
@@ -299,3 +354,1015 @@ next line bold**
         'text:style-name') == 'md2odp-TextDoubleEmphasisStyle')
     assert (odf.get()[0].get_elements('descendant::text:span')[3].text ==
             'bold text\nnext line bold')
+
+
+@with_setup(setup)
+def test_partial_tree():
+    tree = odf_renderer.placeholder()
+    assert tree.get() == []
+    first = odf_renderer.placeholder() + 'first'
+    tree += first
+    tree += ' second'
+    # + leaves its operands alone
+    both = tree + (odf_renderer.placeholder() + ' third')
+    assert [e.text for e in tree.get()] == ['first', ' second']
+    assert [e.text for e in both.get()] == ['first', ' second', ' third']
+    assert [e.text for e in first.get()] == ['first']
+
+    # content after a page goes into its outline frame
+    page = odf_renderer.header(odf_renderer.placeholder() + 'Title', 2)
+    page += odf_renderer.paragraph(both)
+    page += odf_renderer.paragraph(odf_renderer.placeholder() + 'last')
+    assert len(page.get()) == 1
+    frames = page.get()[0].get_elements('descendant::draw:frame')
+    assert frames[1].get_attribute('presentation:class') == 'outline'
+    assert [p.text_recursive for p in frames[1].get_elements(
+        'descendant::text:p')] == ['first second third', 'last']
+    # appends go straight to the remembered outline text box
+    assert odpdown._outline_text_box(page.get()[0]).tag == 'draw:text-box'
+    assert len(page.get()[0].odpdown_outline.children) == 2
+
+
+def test_split_slides():
+    markdown = '''
+# Break
+
+## Slide one
+
+    ## no heading inside code
+
+~~~
+## nor inside fences
+~~~
+
+## Slide two
+### Subheading stays
+* a list
+## glued onto list, no new slide
+
+[1]: http://example.com/
+'''.strip()
+    chunks = odpdown.split_slides(markdown)
+    assert len(chunks) == 3
+    assert all(chunk.startswith('[1]: http://example.com/\n\n')
+               for chunk in chunks)
+    assert '## nor inside fences' in chunks[1]
+    assert '## glued onto list' in chunks[2]
+    assert len(odpdown.split_slides(markdown, lax_heading_mode=True)) == 4
+
+
+def test_render_iter():
+    markdown = codecs.open('cramtest/test.md', 'r', encoding='utf-8').read()
+    markdown = markdown.split('## Test image')[0] + '''
+## Late reference
+
+See [the docs][docs]
+
+## Last slide
+
+* item
+
+[docs]: http://example.com/
+'''
+    consumed = []
+
+    def lines():
+        for line in markdown.splitlines(True):
+            consumed.append(line)
+            yield line
+
+    template = odpdown.Template.load('cramtest/test.odp')
+    pages = []
+    progress = []
+    for page in odpdown.render_iter(lines(), template):
+        pages.append(page)
+        progress.append(len(consumed))
+    # early slides come out before the input is through, the one
+    # waiting for its link definition only at the end
+    assert progress[0] < len(consumed) / 2
+    assert progress[-2] == progress[-1] == len(consumed)
+    assert pages[-2].get_elements('descendant::text:a')[0].get_attribute(
+        'xlink:href') == 'http://example.com/'
+
+    setup()
+    plain = mkdown.render(markdown).get()
+    assert len(pages) == len(plain)
+    for elem, expected in zip(pages, plain):
+        assert ([e.tag for e in elem.get_elements('descendant::*')] ==
+                [e.tag for e in expected.get_elements('descendant::*')])
+
+
+def test_save_streaming():
+    markdown = '\n'.join('## Slide %d\n\n* item %d\n' % (i, i)
+                         for i in range(5))
+    template = odpdown.Template.load('cramtest/test.odp')
+    slides = len(template.document.body.children)
+    output_dir = tempfile.mkdtemp()
+    try:
+        streamed = os.path.join(output_dir, 'streamed.odp')
+        odpdown.save_streaming(
+            template.document, streamed,
+            odpdown.render_iter(markdown.splitlines(True), template),
+            position=1)
+        # document itself stays as it was
+        assert len(template.document.body.children) == slides
+
+        saved = os.path.join(output_dir, 'saved.odp')
+        for index, page in enumerate(odpdown.render_iter(
+                markdown.splitlines(True), template)):
+            template.document.body.insert(page, position=1 + index)
+        template.document.save(target=saved, pretty=False)
+
+        with zipfile.ZipFile(streamed) as zip_file:
+            assert zip_file.infolist()[0].filename == 'mimetype'
+            assert zip_file.infolist()[0].compress_type == zipfile.ZIP_STORED
+            content = zip_file.read('content.xml')
+        with zipfile.ZipFile(saved) as zip_file:
+            expected = zip_file.read('content.xml')
+        uuid_re = re.compile(b'[0-9a-f]{8}-[0-9a-f-]{27}')
+        assert uuid_re.sub(b'', content) == uuid_re.sub(b'', expected)
+
+        streamed = Document(streamed)
+        assert len(streamed.body.children) == slides + 5
+        assert streamed.body.children[1].get_elements(
+            'descendant::text:span')[0].text == 'Slide 0'
+    finally:
+        shutil.rmtree(output_dir)
+
+
+def test_save_streaming_appends_before_settings():
+    markdown = '## Last\n\n* item\n'
+    template = odpdown.Template.load('cramtest/test.odp')
+    output = io.BytesIO()
+    odpdown.save_streaming(
+        template.document, output,
+        odpdown.render_iter(markdown.splitlines(True), template))
+    output.seek(0)
+    children = Document(output).body.children
+    # new slide goes after the last one, settings stay at the end
+    assert [child.tag for child in children[-2:]] == [
+        'draw:page', 'presentation:settings']
+    assert children[-2].get_elements(
+        'descendant::text:span')[0].text == 'Last'
+
+
+def test_compression_policy():
+    policy = odpdown.CompressionPolicy(xml_level=9, level=1)
+    assert policy.level_for('mimetype') is None
+    assert policy.level_for('Pictures/photo.JPG') is None
+    assert policy.level_for('content.xml') == 9
+    assert policy.level_for('Pictures/drawing.svg') == 1
+    assert odpdown.CompressionPolicy(level=0).level_for('a.svg') is None
+
+    markdown = '## Picture\n\n![logo](cramtest/test.svg)\n'
+    template = odpdown.Template.load('cramtest/test.odp')
+    output = io.BytesIO()
+    odpdown.save_streaming(
+        template.document, output,
+        odpdown.render_iter(markdown.splitlines(True), template),
+        compression=odpdown.CompressionPolicy())
+    with zipfile.ZipFile(output) as zip_file:
+        assert zip_file.testzip() is None
+        infos = zip_file.infolist()
+        assert infos[0].filename == 'mimetype'
+        assert infos[0].compress_type == zipfile.ZIP_STORED
+        assert infos[0].extra == b''
+        assert infos[-1].filename == 'META-INF/manifest.xml'
+        for info in infos:
+            if info.filename.endswith('.png'):
+                assert info.compress_type == zipfile.ZIP_STORED
+            elif info.filename.endswith(('.xml', '.svg')):
+                assert info.compress_type == zipfile.ZIP_DEFLATED
+    output.seek(0)
+    document = Document(output)
+    assert len(document.body.children) == len(
+        Document('cramtest/test.odp').body.children) + 1
+
+    # parts deflated on threads come out the same as deflated inline
+    parallel = io.BytesIO()
+    odpdown.save_streaming(
+        template.document, parallel,
+        odpdown.render_iter(markdown.splitlines(True), template),
+        compression=odpdown.CompressionPolicy(threads=2, parallel_min=0))
+    with zipfile.ZipFile(output) as expected, \
+            zipfile.ZipFile(parallel) as zip_file:
+        assert zip_file.testzip() is None
+        for info, expected_info in zip(zip_file.infolist(),
+                                       expected.infolist()):
+            assert info.filename == expected_info.filename
+            assert info.compress_type == expected_info.compress_type
+            if info.filename != 'content.xml':
+                assert info.compress_size == expected_info.compress_size
+                assert (zip_file.read(info) ==
+                        expected.read(expected_info))
+
+
+def test_batch_manifest():
+    manifest = io.StringIO('# comment\n\na.md a.odp\n'
+                           '  "with space.md" out/b.odp\n')
+    manifest.name = os.path.join('decks', 'jobs.txt')
+    assert odpdown._read_manifest(manifest) == [
+        (os.path.join('decks', 'a.md'), os.path.join('decks', 'a.odp')),
+        (os.path.join('decks', 'with space.md'),
+         os.path.join('decks', 'out/b.odp'))]
+
+
+@raises(ValueError)
+def test_batch_manifest_error():
+    odpdown._read_manifest(io.StringIO('a.md\n'))
+
+
+def test_profiler():
+    markdown = ('## Code\n\n```python\nprint("hello")\n```\n\n'
+                '## Picture\n\n![logo](cramtest/test.svg)\n')
+    template = odpdown.Template.load('cramtest/test.odp')
+    renderer = odpdown.ODFRenderer(template.document, 'Nimbus Mono L',
+                                   template=template)
+    profiler = renderer.profiler = odpdown.Profiler()
+    profiler.start()
+    pages = list(odpdown.render_iter(markdown.splitlines(True), template,
+                                     renderer=renderer))
+    with profiler.phase('save'):
+        odpdown.save_streaming(template.document, io.BytesIO(), pages)
+    profiler.stop()
+
+    report = profiler.report()
+    assert [slide['title'] for slide in report['slides']] == [
+        'Code', 'Picture']
+    assert report['phases']['render']['calls'] == 2
+    assert report['phases']['highlight']['tokens'] > 0
+    assert report['slides'][0]['tokens'] == (
+        report['phases']['highlight']['tokens'])
+    assert report['phases']['image']['images'] == 1
+    assert report['slides'][1]['image_bytes'] == os.path.getsize(
+        'cramtest/test.svg')
+    assert report['slides'][1]['elements'] > 1
+    assert report['phases']['save']['calls'] == 1
+    assert report['wall'] >= report['phases']['render']['wall']
+    assert json.loads(json.dumps(report))['slides'] == report['slides']
+
+
+def _conversion_rss(slides, *argv):
+    """Peak rss in kb of a conversion of a generated deck, run in a
+       fresh interpreter"""
+    workdir = tempfile.mkdtemp()
+    try:
+        markdown = os.path.join(workdir, 'deck.md')
+        with open(markdown, 'w') as deck:
+            for index in range(slides):
+                deck.write('## Slide %d\n\n* item with `code`\n'
+                           '    * nested *item*\n\n> quote %d\n\n' %
+                           (index, index))
+        script = ('import odpdown, resource, sys\n'
+                  'odpdown.main(sys.argv[1:])\n'
+                  'print(resource.getrusage('
+                  'resource.RUSAGE_SELF).ru_maxrss)\n')
+        output = subprocess.check_output(
+            [sys.executable, '-c', script, markdown, 'cramtest/test.odp',
+             os.path.join(workdir, 'deck.odp')] + list(argv),
+            stderr=subprocess.DEVNULL)
+        return int(output.split()[-1])
+    finally:
+        shutil.rmtree(workdir)
+
+
+def test_low_memory():
+    # peak memory grows with the largest slide, not the deck
+    for argv in ([], ['-j', '2']):
+        small = _conversion_rss(100, '--low-memory', *argv)
+        large = _conversion_rss(1000, '--low-memory', *argv)
+        assert large - small < 8 * 1024, (argv, small, large)
+
+
+def test_slide_spool():
+    data = [os.urandom(100).hex().encode('ascii') * 50, b'<p/>' * 1000]
+    for max_size in (0, 16 * 1024 * 1024):
+        with odpdown.SlideSpool(max_size) as spool:
+            for chunk in data:
+                spool.write(chunk)
+            assert spool.size == sum(len(chunk) for chunk in data)
+            assert b''.join(spool.chunks()) == b''.join(data)
+
+
+def test_slide_cache():
+    markdown = codecs.open('cramtest/test.md', 'r', encoding='utf-8').read()
+    # no network access for the image tests
+    markdown = markdown.split('## Test image')[0] + '''
+## Local image
+
+![This is alt text](cramtest/test.svg)
+'''
+    cache_dir = tempfile.mkdtemp()
+    try:
+        results = []
+        for run in range(2):
+            setup()
+            cache = odpdown.SlideCache(cache_dir)
+            results.append(odpdown.render_slides(mkdown, markdown, cache=cache))
+            # cached slides bring their pictures along
+            assert '.svg' in [x[-4:] for x in testdoc.get_part(
+                ODF_MANIFEST).get_paths()]
+        assert cache.hits == 6 and cache.misses == 0
+        # a changed template invalidates all slides
+        setup()
+        odf_renderer.template.digest = 'changed'
+        odpdown.render_slides(mkdown, markdown, cache=cache)
+        assert cache.hits == 6 and cache.misses == 6
+        setup()
+        plain = mkdown.render(markdown).get()
+        for elements in results:
+            assert len(elements) == len(plain)
+            for elem, expected in zip(elements, plain):
+                assert (len(elem.get_elements('descendant::*')) ==
+                        len(expected.get_elements('descendant::*')))
+    finally:
+        shutil.rmtree(cache_dir)
+
+
+@with_setup(setup)
+def test_parallel_slides():
+    markdown = '\n'.join('''
+## Slide %d
+
+* item with `code`
+
+![logo](cramtest/test.svg)
+
+~~~ python
+print(%d)
+~~~
+''' % (i, i) for i in range(8))
+    cache_dir = tempfile.mkdtemp()
+    try:
+        odf_renderer.highlight_cache = odpdown.HighlightCache(path=cache_dir)
+        elements = odpdown.render_slides(mkdown, markdown, jobs=2,
+                                         template='cramtest/test.odp')
+        # workers highlight through the same disk cache
+        assert len(os.listdir(cache_dir)) == 8
+    finally:
+        odf_renderer.highlight_cache = odpdown.HighlightCache()
+        shutil.rmtree(cache_dir)
+    plain = mkdown.render(markdown).get()
+    assert len(elements) == len(plain) == 8
+    for elem, expected in zip(elements, plain):
+        assert isinstance(elem, DrawPage)
+        assert len(elem.get_elements('descendant::draw:image')) == 1
+        assert ([e.text for e in elem.get_elements('descendant::text:span')] ==
+                [e.text for e in expected.get_elements(
+                    'descendant::text:span')])
+
+
+@with_setup(setup)
+def test_table():
+    markdown = '''
+## Status
+
+| Team | Owner | State |
+|:-----|:-----:|------:|
+| Core | *alice* | **done** |
+| Docs | bob | `wip` |
+'''.strip()
+    pages = mkdown.render(markdown).get()
+    assert len(pages) == 1
+    tables = pages[0].get_elements('draw:frame/table:table')
+    assert len(tables) == 1
+    assert len(tables[0].get_elements('table:table-column')) == 3
+    rows = tables[0].get_elements('table:table-row')
+    assert [[cell.text_recursive.strip() for cell in row.get_elements(
+        'table:table-cell')] for row in rows] == [
+            ['Team', 'Owner', 'State'], ['Core', 'alice', 'done'],
+            ['Docs', 'bob', 'wip']]
+    assert [cell.get_attribute('table:style-name') for cell in
+            rows[0].get_elements('table:table-cell')] == [
+                'md2odp-TableHeaderCellStyle'] * 3
+    assert [para.get_attribute('text:style-name') for para in
+            rows[1].get_elements('descendant::text:p')] == [
+                'md2odp-TableParagraphLeft', 'md2odp-TableParagraphCenter',
+                'md2odp-TableParagraphRight']
+    assert 'md2odp-TextEmphasisStyle' in [
+        span.get_attribute('text:style-name')
+        for span in rows[1].get_elements('descendant::text:span')]
+    index = odpdown.style_index(testdoc)
+    for family, name in (('table-cell', 'md2odp-TableCellStyle'),
+                         ('paragraph', 'md2odp-TableParagraphRight'),
+                         ('table-column', 'md2odp-TableColumn7333')):
+        assert index.get_style(family, name) is not None
+
+
+@with_setup(setup)
+def test_table_pagination():
+    markdown = '## Big\n\nIntro\n\n| Key | Value |\n|---|---|\n' + ''.join(
+        '| %d | value %d |\n' % (i, i) for i in range(100)) + '''
+After the table
+
+## Next
+
+| Key | Value |
+|---|---|
+| a | b |
+'''
+    pages = mkdown.render(markdown).get()
+    outline_height = float(odf_renderer.outline_size[1][:-2])
+    keys = []
+    for page in pages[1:-1]:
+        assert page.get_elements(
+            'draw:frame')[0].text_recursive.strip() == 'Big'
+        frames = page.get_elements('draw:frame[table:table]')
+        if not frames:
+            continue
+        assert float(frames[0].get_attribute('svg:height')[:-2]) <= (
+            outline_height)
+        rows = frames[0].get_elements('table:table/table:table-row')
+        # each continuation repeats the header row
+        assert rows[0].text_recursive.split() == ['Key', 'Value']
+        keys.extend(row.text_recursive.split()[0] for row in rows[1:])
+    assert keys == [str(i) for i in range(100)]
+    # text around a table stays on slides of its own
+    assert pages[0].get_elements(
+        'draw:frame')[1].text_recursive.strip() == 'Intro'
+    assert not pages[0].get_elements('descendant::table:table')
+    assert pages[-2].get_elements(
+        'draw:frame')[1].text_recursive.strip() == 'After the table'
+    assert len(pages) > 4
+    # small tables go right onto the slide of their heading
+    assert len(pages[-1].get_elements('draw:frame/table:table')) == 1
+
+    # same split when rendered elsewhere
+    cache = odpdown.SlideCache(tempfile.mkdtemp())
+    try:
+        for _ in range(2):
+            document = Document('cramtest/test.odp')
+            renderer = odpdown.ODFRenderer(document, 'Nimbus Mono L')
+            cached = odpdown.render_slides(
+                mistune.Markdown(renderer=renderer), markdown, cache=cache)
+            assert ([len(page.get_elements('descendant::table:table-row'))
+                     for page in cached] ==
+                    [len(page.get_elements('descendant::table:table-row'))
+                     for page in pages])
+        assert cache.hits == 2
+        assert odpdown.style_index(document).get_style(
+            'table-cell', 'md2odp-TableHeaderCellStyle') is not None
+    finally:
+        shutil.rmtree(cache.path)
+
+
+@with_setup(setup)
+def test_table_nested():
+    table = '| Key | Value |\n|---|---|\n' + ''.join(
+        '| %d | value %d |\n' % (i, i) for i in range(40))
+    markdown = ('## Quoted\n\n> Before\n>\n' +
+                ''.join('> ' + line + '\n' for line in table.splitlines()) +
+                '>\n> After\n\n* one\n\n  > ' +
+                '\n  > '.join(table.splitlines()[:4]) + '\n\n  two\n')
+    pages = mkdown.render(markdown).get()
+    # tables come out of quotes and lists, onto slides of their own -
+    # nothing ends up inside a paragraph or list
+    for page in pages:
+        assert isinstance(page, DrawPage)
+        assert not page.get_elements('descendant::draw:page')
+        assert not page.get_elements('descendant::text:p//table:table')
+        assert not page.get_elements('descendant::text:list//table:table')
+    texts = [[frame.text_recursive.strip()
+              for frame in page.get_elements('draw:frame')[1:]]
+             for page in pages]
+    assert texts[0] == ['\u201dBefore\u201d']
+    tables = [page.get_elements('draw:frame/table:table')
+              for page in pages]
+    assert all(tables[1:-3]) and not any(tables[-3::2])
+    assert sum(len(page.get_elements('descendant::table:table-row')) - 1
+               for page in pages[1:-3]) == 40
+    # no empty quote on the continuations - the rest goes on afterwards
+    assert all(len(frames) == 1 for frames in texts[1:-3])
+    assert texts[-3][0].startswith('\u201dAfter\u201d')
+    assert 'one' in texts[-3][0]
+    assert len(pages[-2].get_elements(
+        'descendant::table:table-row')) == 3
+    assert 'two' in texts[-1][0]
+
+
+def test_table_outline_units():
+    markdown = '## Units\n\n| Key | Value |\n|---|---|\n' + ''.join(
+        '| %d | value %d |\n' % (i, i) for i in range(40))
+    splits = []
+    for outline_size in (('22cm', '12cm'), ('623.62pt', '340.16pt'),
+                         ('80%', '12cm')):
+        document = Document('cramtest/test.odp')
+        renderer = odpdown.ODFRenderer(document, 'Nimbus Mono L',
+                                       outline_size=outline_size)
+        pages = mistune.Markdown(renderer=renderer).render(markdown).get()
+        splits.append(
+            [len(page.get_elements('descendant::table:table-row'))
+             for page in pages])
+    # points give the same split as centimeters, relative widths fall
+    # back to the default outline's
+    assert splits[0] == splits[1] == splits[2]
+    assert len(splits[0]) > 1
+
+
+def test_highlight_cache():
+    cache_dir = tempfile.mkdtemp()
+    try:
+        cache = odpdown.HighlightCache(path=cache_dir)
+        code = 'if [ $? -eq 0 ]; then\n    echo  ok\nfi'
+        first = cache.highlight(code, 'bash', 'colorful')
+        second = cache.highlight(code, 'bash', 'colorful')
+        assert (cache.hits, cache.disk_hits, cache.misses) == (1, 0, 1)
+        assert ([e.serialize() for e in first] ==
+                [e.serialize() for e in second])
+        assert first[0] is not second[0]
+
+        # fresh process-wide state, only disk tier left
+        cache = odpdown.HighlightCache(path=cache_dir)
+        third = cache.highlight(code, 'bash', 'colorful')
+        assert (cache.hits, cache.disk_hits, cache.misses) == (0, 1, 0)
+        assert ([(e.tag, e.text, e.get_attribute('text:style-name'))
+                 for e in first] ==
+                [(e.tag, e.text or '', e.get_attribute('text:style-name'))
+                 for e in third])
+        cache.highlight(code, 'bash', 'emacs')
+        assert cache.misses == 1
+        assert odpdown.get_lexer('bash') is odpdown.get_lexer('bash')
+
+        # broken entries are misses, the disk tier gets trimmed
+        for name in os.listdir(cache_dir):
+            with open(os.path.join(cache_dir, name), 'wb') as entry:
+                entry.write(b'<text:p><text:span>')
+        cache = odpdown.HighlightCache(path=cache_dir, size_limit=0)
+        cache.highlight(code, 'bash', 'colorful')
+        assert cache.misses == 1
+        cache.trim()
+        assert os.listdir(cache_dir) == []
+    finally:
+        shutil.rmtree(cache_dir)
+
+
+def test_lazy_imports():
+    # keep startup cheap for --version, argument errors etc
+    heavy = ('odfdo', 'pygments', 'urllib.request', 'multiprocessing',
+             'PIL', 'bs4', 'socketserver', 'zipfile', 'tempfile')
+    modules = subprocess.check_output(
+        [sys.executable, '-c',
+         'import sys, odpdown; print(" ".join(sys.modules))']).split()
+    assert not [m for m in modules
+                if m.decode('ascii').split('.')[0] in heavy or
+                m.decode('ascii') in heavy]
+
+
+def test_helpers_without_renderer():
+    # helpers must not depend on a renderer having imported odfdo
+    output = subprocess.check_output(
+        [sys.executable, '-c',
+         'import odpdown\n'
+         'print(len(odpdown.handle_whitespace("a  b")))\n'
+         'tree = odpdown.ODFPartialTree([], (1, 1), (0, 0))\n'
+         'tree += "x"\n'
+         'print(len(tree.get()))'])
+    assert output.split() == [b'3', b'1']
+
+
+@with_setup(setup)
+def test_image_prefetch():
+    server, url = start_image_server()
+    try:
+        markdown = '''
+[1]: %stest.svg?variant=1
+
+## Remote image
+
+![Inline](%stest.svg "title")
+
+## Referenced image
+
+![Referenced][1]
+
+## Missing image
+
+![Missing](%smissing.svg)
+'''.strip() % (url, url, url)
+        sources = odpdown.find_images(markdown)
+        assert sources == [url + 'test.svg', url + 'missing.svg',
+                           url + 'test.svg?variant=1']
+        # nothing to fetch for images in code
+        assert odpdown.find_images(
+            '```\n![a](a.png)\n```\n\n    ![b](b.png)\n\n`![c](c.png)`'
+            '\n\n![d](d.png)\n') == ['d.png']
+
+        prefetcher = odf_renderer.prefetcher = odpdown.ImagePrefetcher(
+            max_workers=1)
+        prefetcher.prefetch([sources[0], sources[2]])
+        odf = mkdown.render(markdown.split('## Missing')[0])
+        prefetcher.close()
+        # one thread, one host - one connection
+        assert len(_http_connections) == 1
+        assert len(odf.get()) == 2
+        for page in odf.get():
+            frame = page.get_elements('descendant::draw:frame')[1]
+            assert frame.get_attribute('svg:width') == '22cm'
+            assert frame.get_attribute('svg:height') == '9cm'
+
+        # an image on several slides gets fetched once
+        requests = len(_http_statuses)
+        prefetcher.prefetch([sources[0]])
+        odf = mkdown.render('## One\n\n![a](%s)\n\n## Two\n\n![b](%s)\n'
+                            % (sources[0], sources[0]))
+        assert len(odf.get()) == 2
+        assert len(_http_statuses) == requests + 1
+        prefetcher.close()
+
+        # errors surface when rendering the image in question
+        prefetcher.prefetch(sources)
+        try:
+            mkdown.render(markdown)
+            assert False, 'missing image must raise'
+        except HTTPError as exc:
+            assert exc.code == 404
+        prefetcher.close()
+
+        # proxy settings get honoured
+        environ = dict(os.environ)
+        os.environ.update({'http_proxy': url, 'no_proxy': ''})
+        os.environ.pop('NO_PROXY', None)
+        try:
+            prefetcher.prefetch(['http://images.invalid/test.svg'])
+            imagedata, size = prefetcher.result(
+                'http://images.invalid/test.svg')
+            with open('cramtest/test.svg', 'rb') as svg:
+                assert imagedata == svg.read()
+        finally:
+            os.environ.clear()
+            os.environ.update(environ)
+            prefetcher.close()
+    finally:
+        odf_renderer.prefetcher = None
+        server.shutdown()
+        server.server_close()
+
+
+def test_remote_image_cache():
+    server, url = start_image_server()
+    cache_dir = tempfile.mkdtemp()
+    try:
+        cache = odpdown.RemoteImageCache(cache_dir)
+        data = cache.fetch(url + 'test.svg')
+        with open('cramtest/test.svg', 'rb') as svg:
+            assert data == svg.read()
+        assert (cache.hits, cache.misses) == (0, 1)
+        assert _http_statuses == [200]
+
+        # revalidated via If-Modified-Since, both with urllib and the
+        # prefetcher's pooled connections
+        assert odpdown.load_image(url + 'test.svg', cache)[0] == data
+        prefetcher = odpdown.ImagePrefetcher(max_workers=1,
+                                             http_cache=cache)
+        prefetcher.prefetch([url + 'test.svg'])
+        imagedata, size = prefetcher.result(url + 'test.svg')
+        prefetcher.close()
+        assert imagedata == data
+        assert size == odpdown.probe_image(data, 'svg')
+        assert (cache.hits, cache.misses) == (2, 1)
+        assert _http_statuses == [200, 304, 304]
+
+        # offline, cached copies only
+        server.shutdown()
+        server.server_close()
+        offline = odpdown.RemoteImageCache(cache_dir, offline=True)
+        assert offline.fetch(url + 'test.svg') == data
+        try:
+            offline.fetch(url + 'missing.svg')
+            assert False, 'uncached image must raise when offline'
+        except URLError:
+            pass
+        assert len(_http_statuses) == 3
+
+        # least recently used entry gets evicted first
+        for age, name in enumerate(('a.png', 'b.png')):
+            offline._store(url + name, {}, b'x' * 4096)
+            os.utime(offline._entry_path(url + name), (age, age))
+        offline.size_limit = 4096 + len(data) + 200
+        offline.trim()
+        assert offline.fetch(url + 'test.svg') == data
+        assert not os.path.exists(offline._entry_path(url + 'a.png'))
+    finally:
+        server.shutdown()
+        server.server_close()
+        shutil.rmtree(cache_dir)
+
+
+def test_template():
+    cache_dir = tempfile.mkdtemp()
+    try:
+        template = odpdown.Template.load('cramtest/test.odp', cache_dir)
+        assert template.master_names == ['Standard', 'Default',
+                                         'libreoffice_5f_en']
+        geometry = template.geometry('Standard', 'Default')
+        assert sorted(geometry) == [
+            'breakheader_position', 'breakheader_size', 'header_position',
+            'header_size', 'outline_position', 'outline_size']
+        assert template.list_style('Default').tag == 'text:list-style'
+        assert template.list_style('nonexistent') is None
+        assert os.listdir(cache_dir) == [template.digest + '.json']
+
+        # second load takes the analysis from the sidecar
+        analyse = odpdown.Template._analyse
+        odpdown.Template._analyse = None
+        try:
+            cached = odpdown.Template.load('cramtest/test.odp', cache_dir)
+        finally:
+            odpdown.Template._analyse = analyse
+        assert cached.master_names == template.master_names
+        assert cached.geometry('Standard', 'Default') == geometry
+        assert (cached.list_style('Default').serialize() ==
+                template.list_style('Default').serialize())
+
+        # ... and rendering onto it skips the styles.xml walk
+        index_styles = odpdown.StyleIndex._index_styles
+        odpdown.StyleIndex._index_styles = None
+        try:
+            renderer = odpdown.ODFRenderer(cached.document, 'Nimbus Mono L',
+                                           template=cached, **geometry)
+        finally:
+            odpdown.StyleIndex._index_styles = index_styles
+        assert renderer.outline_size == geometry['outline_size']
+        assert cached.document.content.get_elements(
+            'descendant::text:list-style[@style:name="OutlineListStyle"]')
+    finally:
+        shutil.rmtree(cache_dir)
+
+
+_code_deck = '## Code\n\n```python\ndef answer():\n    return 42\n```\n'
+
+
+def _formatter_style_names(style):
+    document = Document('presentation')
+    odpdown.get_formatter(style).add_style_defs(document)
+    return set(re.findall(r'md2odp-T(?:Color|Bold|Italic)\w*',
+                          document.content.serialize().decode('utf-8')))
+
+
+def test_highlight_styles():
+    # only highlight styles the deck uses get added
+    document = Document('cramtest/test.odp')
+    renderer = odpdown.ODFRenderer(document, 'Nimbus Mono L')
+    index = odpdown.style_index(document)
+    assert index.get_style('text', 'md2odp-TColor008800Bold') is None
+    assert index.get_style('text', 'md2odp-TextCodeStyle') is not None
+    mistune.Markdown(renderer=renderer).render(_code_deck)
+    used = set(re.findall(r'md2odp-T(?:Color|Bold|Italic)\w*',
+                          document.content.serialize().decode('utf-8')))
+    assert 'md2odp-TColor008800Bold' in used
+    assert len(used) < len(_formatter_style_names('colorful'))
+
+    # slides rendered elsewhere bring theirs along
+    template = odpdown.Template.load('cramtest/test.odp')
+    renderer = odpdown.ODFRenderer(template.document, 'Nimbus Mono L',
+                                   template=template)
+    cache = odpdown.SlideCache(tempfile.mkdtemp())
+    try:
+        for _ in range(2):
+            odpdown.render_slides(mistune.Markdown(renderer=renderer),
+                                  _code_deck, cache=cache)
+        assert cache.hits == 1
+        fresh = odpdown.Template.load('cramtest/test.odp')
+        renderer = odpdown.ODFRenderer(fresh.document, 'Nimbus Mono L',
+                                       template=fresh)
+        odpdown.render_slides(mistune.Markdown(renderer=renderer),
+                              _code_deck, cache=cache)
+        assert odpdown.style_index(fresh.document).get_style(
+            'text', 'md2odp-TColor008800Bold') is not None
+    finally:
+        shutil.rmtree(cache.path)
+
+
+def test_highlight_flat_spans():
+    # one span per token run, carrying a merged style
+    assert odpdown._highlight_style_properties(
+        'md2odp-TColor008800Bold') == [
+            ('text', {'color': '#008800', 'font_weight': 'bold'})]
+    assert odpdown._highlight_style_properties('md2odp-TBold') == [
+        ('text', {'font_weight': 'bold'})]
+    assert odpdown._highlight_style_properties('md2odp-TextCodeStyle') \
+        is None
+
+    document = Document('cramtest/test.odp')
+    odf = mistune.Markdown(renderer=odpdown.ODFRenderer(
+        document, 'Nimbus Mono L')).render(_code_deck)
+    spans = [span for page in odf.get()
+             for span in page.get_elements('descendant::text:span')]
+    assert 'md2odp-TColor008800Bold' in [
+        span.get_attribute('text:style-name') for span in spans]
+    for span in spans:
+        assert not span.get_elements('descendant::text:span')
+
+
+def _text_runs(elem):
+    """(text, enclosing span styles) runs of all paragraphs below elem,
+       whatever their span structure"""
+    text_ns = '{urn:oasis:names:tc:opendocument:xmlns:text:1.0}'
+    runs = []
+
+    def add(text, styles):
+        if not text:
+            return
+        if runs and runs[-1][1] == styles:
+            runs[-1] = (runs[-1][0] + text, styles)
+        else:
+            runs.append((text, styles))
+
+    def walk(node, styles):
+        add(node.text, styles)
+        for child in node:
+            if child.tag == text_ns + 'span':
+                style = child.get(text_ns + 'style-name')
+                walk(child, styles + (style,) if style else styles)
+            elif child.tag == text_ns + 's':
+                add(' ' * int(child.get(text_ns + 'c', 1)), styles)
+            else:
+                runs.append((child.tag, styles))
+                walk(child, styles)
+            add(child.tail, styles)
+
+    walk(elem._xml_element, ())
+    return runs
+
+
+def test_minimize_xml():
+    para = Element.from_tag(
+        '<text:p><text:span><text:span text:style-name="A">x</text:span>'
+        '<text:span text:style-name="A">y<text:s/></text:span>'
+        '<text:span text:style-name="A"><text:s text:c="2"/>z</text:span>'
+        '</text:span><text:span text:style-name="B"/>tail</text:p>')
+    odpdown.minimize_elements([para])
+    assert para.serialize() == (
+        '<text:p><text:span text:style-name="A">xy<text:s text:c="3"/>z'
+        '</text:span>tail</text:p>')
+
+    markdown = '''
+## Heading
+
+There *is* **some** `code` and *more* *emphasis*
+
+* item with [a link](http://example.org/) and ***both***
+*
+
+> quote with **bold
+> lines**
+
+~~~ bash
+if [ $? -eq 0 ];   then
+\techo   "spaces"
+fi
+~~~
+'''.strip() + '\n\n' + _code_deck
+    pages = {}
+    for minimize in (False, True):
+        renderer = odpdown.ODFRenderer(Document('cramtest/test.odp'),
+                                       'Nimbus Mono L',
+                                       minimize_xml=minimize)
+        pages[minimize] = odpdown.render_slides(
+            mistune.Markdown(renderer=renderer), markdown)
+    assert len(pages[False]) == len(pages[True]) == 2
+    for plain, lean in zip(pages[False], pages[True]):
+        assert _text_runs(lean) == _text_runs(plain)
+        assert len(lean.serialize()) < len(plain.serialize())
+        for span in lean.get_elements('descendant::text:span'):
+            assert span.get_attribute('text:style-name')
+            assert span.text or span.children
+
+
+def test_style_index():
+    document = Document('cramtest/test.odp')
+    index = odpdown.style_index(document)
+    assert odpdown.style_index(document) is index
+    assert index.master_names == ['Standard', 'Default',
+                                  'libreoffice_5f_en']
+    assert index.placeholder('Default', 'outline').get_attribute(
+        'presentation:class') == 'outline'
+    assert index.placeholder('Default', 'nonexistent') is None
+    assert index.get_style('presentation', 'Default-outline1') is not None
+
+    # renderer and formatter styles go through the index, replacing
+    # instead of duplicating on repeated insertion
+    for _ in range(2):
+        mistune.Markdown(renderer=odpdown.ODFRenderer(
+            document, 'Nimbus Mono L')).render(_code_deck)
+    for name in ('md2odp-TextCodeStyle', 'md2odp-TColor008800Bold'):
+        assert index.get_style('text', name) is not None
+        assert len(document.content.get_elements(
+            '//style:style[@style:name="%s"]' % name)) == 1
+    assert len(document.content.get_elements(
+        '//style:font-face[@style:name="Nimbus Mono L"]')) == 1
+
+
+def test_style_registry():
+    document = Document('cramtest/test.odp')
+    odpdown.ODFRenderer(document, 'Nimbus Mono L')
+    odpdown.add_style(document, 'text', 'md2odp-TBold',
+                      [('text', {'font_weight': 'bold'})])
+    index = odpdown.style_index(document)
+    bold = index.get_style('text', 'md2odp-TBold')
+    count = len(document.content.get_elements('//style:style'))
+
+    # same style again: nothing changes
+    odpdown.add_style(document, 'text', 'md2odp-TBold',
+                      [('text', {'font_weight': 'bold'})])
+    same = bold.clone
+    assert index.insert_style(same) is bold
+    odpdown.ODFRenderer(document, 'Nimbus Mono L')
+    assert index.get_style('text', 'md2odp-TBold') is bold
+    assert len(document.content.get_elements('//style:style')) == count
+
+    # different content replaces
+    odpdown.add_style(document, 'text', 'md2odp-TBold',
+                      [('text', {'font_weight': '600'})])
+    assert index.get_style('text', 'md2odp-TBold') is not bold
+    assert len(document.content.get_elements(
+        '//style:style[@style:name="md2odp-TBold"]')) == 1
+
+    # equal doubles from earlier runs get dropped when indexing
+    automatic = document.content.get_element('//office:automatic-styles')
+    bold = index.get_style('text', 'md2odp-TBold')
+    automatic.append(bold.clone)
+    automatic.append(bold.clone)
+    rebuilt = odpdown.StyleIndex(document)
+    assert len(document.content.get_elements(
+        '//style:style[@style:name="md2odp-TBold"]')) == 1
+    assert rebuilt.get_style('text', 'md2odp-TBold') is not None
+
+
+def test_picture_dedup():
+    global testdoc, odf_renderer, mkdown
+    testdoc = Document('cramtest/test.odp')
+    odf_renderer = odpdown.ODFRenderer(testdoc, 'Nimbus Mono L')
+    mkdown = mistune.Markdown(renderer=odf_renderer)
+    template_pictures = [x for x in testdoc.parts
+                         if x.startswith('Pictures/')]
+
+    picture_dir = tempfile.mkdtemp()
+    try:
+        # copy of a picture the template has already
+        logo = os.path.join(picture_dir, 'logo.png')
+        with open(logo, 'wb') as out:
+            out.write(testdoc.get_part(template_pictures[0]))
+        markdown = '''
+## One
+
+![svg](cramtest/test.svg)
+
+## Two
+
+![same svg, other name](cramtest/test.svg;_-^!$%%&=+#test)
+
+## Three
+
+![logo](%s)
+'''.strip() % logo
+        odf = mkdown.render(markdown)
+        hrefs = [page.get_elements('descendant::draw:image')[0].get_attribute(
+            'xlink:href') for page in odf.get()]
+        assert hrefs[0] == hrefs[1]
+        assert hrefs[2] == template_pictures[0]
+        manifest = testdoc.get_part(ODF_MANIFEST).get_paths()
+        assert len([x for x in manifest if x.startswith('Pictures/')]) == (
+            len(template_pictures) + 1)
+        assert manifest.count(hrefs[0]) == 1
+    finally:
+        shutil.rmtree(picture_dir)
+
+
+@with_setup(setup)
+def test_optimize_pictures():
+    from PIL import Image
+
+    picture_dir = tempfile.mkdtemp()
+    try:
+        photo = os.path.join(picture_dir, 'photo.jpg')
+        Image.radial_gradient('L').resize((3000, 2000)).convert(
+            'RGB').save(photo, quality=100)
+        markdown = '''
+## Photo
+
+![photo](%s)
+'''.strip() % photo
+        odf = mkdown.render(markdown)
+        name = odf.get()[0].get_elements(
+            'descendant::draw:image')[0].get_attribute('xlink:href')
+        original = testdoc.get_part(name)
+
+        cache_dir = os.path.join(picture_dir, 'cache')
+        for run in range(2):
+            testdoc.set_part(name, original)
+            result = odpdown.optimize_pictures(testdoc, odf.get(), dpi=100,
+                                               cache_dir=cache_dir)
+            assert list(result) == [name]
+            assert len(testdoc.get_part(name)) < len(original)
+            # 18cm x 12cm frame at 100dpi
+            assert Image.open(io.BytesIO(testdoc.get_part(
+                name))).size == (709, 473)
+        assert len(os.listdir(cache_dir)) == 1
+
+        # broken pictures stay as they are
+        for broken in (original[:len(original) // 2], b'garbage'):
+            assert odpdown._optimize_picture(
+                (broken, (100, 100), 85)) == broken
+    finally:
+        shutil.rmtree(picture_dir)